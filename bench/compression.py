@@ -0,0 +1,168 @@
+# compression.py - time real uploads and downloads with and without
+# transfer compression, on compressed and uncompressed payloads
+#
+# Uploads run rsync with and without -z to a local directory, through a
+# stand-in for ssh which runs the remote command locally.  Downloads run
+# curl with and without --compressed against a local HTTP server which
+# gzips responses on the fly when asked to.  The link speed is emulated
+# with rsync's --bwlimit and curl's --limit-rate, 0 leaves it unlimited.
+#
+#   python bench/compression.py [link MB/s] [payload MB]
+
+import os
+import sys
+import time
+import zlib
+import shutil
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SimpleHTTPServer
+
+sys.path.insert(0, os.path.abspath('src/pygoosepkg'))
+import lookaside
+
+
+def payloads(size):
+    """Return (name, data) payloads standing in for typical sources"""
+
+    # Something like a source tree in a plain tarball
+    text = open(lookaside.__file__.replace('.pyc', '.py'), 'rb').read()
+    plain = (text * (size / len(text) + 1))[:size]
+    return [('foo-1.0.tar', plain),
+            ('foo-1.0.tar.gz', zlib.compress(os.urandom(size), 9)[:size]),
+            ('foo-1.0.tar.xz', os.urandom(size))]
+
+
+class GzipHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve files, gzipping them on the fly if the client accepts it"""
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if gzip:
+            # The length is not known up front, the end of the response
+            # is the connection closing.
+            self.send_header('Content-Encoding', 'gzip')
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        else:
+            self.send_header('Content-Length', os.path.getsize(path))
+        self.end_headers()
+        input = open(path, 'rb')
+        try:
+            while True:
+                chunk = input.read(65536)
+                if not chunk:
+                    break
+                if gzip:
+                    chunk = compressor.compress(chunk)
+                self.wfile.write(chunk)
+            if gzip:
+                self.wfile.write(compressor.flush())
+        finally:
+            input.close()
+
+    def log_message(self, *args):
+        pass
+
+
+def rsh(workdir):
+    """Write an ssh stand-in running the remote command locally"""
+
+    path = os.path.join(workdir, 'rsh')
+    open(path, 'w').write('#!/bin/sh\n# drop the host\nshift\nexec "$@"\n')
+    os.chmod(path, 0755)
+    return path
+
+
+def timed(command):
+    """Return the seconds command took"""
+
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        subprocess.check_call(command, stdout=devnull)
+    finally:
+        devnull.close()
+    return time.time() - start
+
+
+def time_rsync(path, workdir, link, compress):
+    """Return the MB/s of an rsync upload of path"""
+
+    dest = tempfile.mkdtemp(dir=workdir)
+    command = ['rsync', '-lt', '-e', rsh(workdir), path,
+               'localhost:%s/' % dest]
+    if compress:
+        command.insert(1, '-z')
+    if link:
+        command.insert(1, '--bwlimit=%d' % (link * 1024))
+    try:
+        return os.path.getsize(path) / 1048576.0 / timed(command)
+    finally:
+        shutil.rmtree(dest)
+
+
+def time_curl(url, size, link, compress):
+    """Return the MB/s of a curl download of url"""
+
+    command = ['curl', '-s', '-S', '--fail', '-o', os.devnull, url]
+    if compress:
+        command.insert(1, '--compressed')
+    if link:
+        command[1:1] = ['--limit-rate', '%dk' % (link * 1024)]
+    return size / 1048576.0 / timed(command)
+
+
+if __name__ == '__main__':
+    link = len(sys.argv) > 1 and float(sys.argv[1]) or 0
+    size = (len(sys.argv) > 2 and int(sys.argv[2]) or 16) * 1048576
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), GzipHandler)
+    server = threading.Thread(target=httpd.serve_forever)
+    server.daemon = True
+    server.start()
+    have_rsync = not subprocess.call('command -v rsync >/dev/null',
+                                     shell=True)
+    if not have_rsync:
+        sys.stderr.write('rsync not found, only timing curl\n')
+
+    print('link %s, %d MB payloads' % (link and '%.1f MB/s' % link or
+                                       'unlimited', size / 1048576))
+    print('%-16s %8s %10s %10s %10s %12s %8s' %
+          ('payload', 'decide', 'rsync', 'rsync -z', 'curl',
+           '--compressed', 'chosen'))
+    try:
+        for name, data in payloads(size):
+            path = os.path.join(workdir, name)
+            open(path, 'wb').write(data)
+            start = time.time()
+            compress = lookaside.compressible(path)
+            decide = time.time() - start
+
+            results = []
+            if have_rsync:
+                for z in (False, True):
+                    results.append('%6.1fMB/s' %
+                                   time_rsync(path, workdir, link, z))
+            else:
+                results.extend(['-', '-'])
+            url = 'http://127.0.0.1:%d/%s' % (httpd.server_port, name)
+            for z in (False, True):
+                results.append('%6.1fMB/s' % time_curl(url, size, link, z))
+            print('%-16s %6.1fms %10s %10s %10s %12s %8s' %
+                  tuple([name, decide * 1000] + results +
+                        [compress and '-z' or 'plain']))
+            os.unlink(path)
+    finally:
+        httpd.shutdown()
+        os.chdir('/')
+        shutil.rmtree(workdir)
@@ -0,0 +1,40 @@
+# startup.py - compare goosepkg client construction with and without the
+# generated command registry
+#
+# Run from the top of the source tree after generating the registry:
+#
+#   python src/goosepkg_registry.py > src/pygoosepkg/registry.py
+#   python bench/startup.py [command] [repeat]
+
+import sys
+import timeit
+
+sys.path.insert(0, 'src')
+import pygoosepkg
+
+
+def construct(argv, lazy):
+    """Build a client the way the goosepkg script does for argv"""
+
+    sys.argv = argv
+    pygoosepkg.cli.goosepkgClient(config=None, lazy=lazy)
+
+
+if __name__ == '__main__':
+    command = len(sys.argv) > 1 and sys.argv[1] or 'sources'
+    repeat = len(sys.argv) > 2 and int(sys.argv[2]) or 50
+    argv = ['goosepkg', command]
+
+    if pygoosepkg.cli.registry is None:
+        sys.stderr.write('No command registry, lazy runs build the full '
+                         'tree too\n')
+
+    full = min(timeit.repeat(lambda: construct(argv, False), number=1,
+                             repeat=repeat))
+    lazy = min(timeit.repeat(lambda: construct(argv, True), number=1,
+                             repeat=repeat))
+
+    print('goosepkg %s, best of %d' % (command, repeat))
+    print('  full command tree: %8.2f ms' % (full * 1000))
+    print('  registry lookup:   %8.2f ms' % (lazy * 1000))
+    print('  speedup:           %8.1fx' % (full / lazy))
@@ -1,4 +1,33 @@
+import os
+import sys
+from distutils import log
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
+
+class build_py_registry(build_py):
+    """Build the modules along with the generated command registry"""
+
+    def run(self):
+        build_py.run(self)
+        # Generate from this source tree, not an installed goosepkg
+        registry = os.path.join(self.build_lib, 'pygoosepkg', 'registry.py')
+        sys.path.insert(0, 'src')
+        try:
+            import goosepkg_registry
+            out = open(registry, 'w')
+            try:
+                goosepkg_registry.generate(out)
+            finally:
+                out.close()
+        except Exception, e:
+            # goosepkg still works, building every parser at startup
+            log.warn('Not generating the command registry: %s' % e)
+            if os.path.exists(registry):
+                os.unlink(registry)
+        finally:
+            sys.path.remove('src')
+
 
 setup(
     name = "goosepkg",
@@ -12,7 +41,8 @@ setup(
     package_dir = {'': 'src'},
     packages = ['pygoosepkg'],
     scripts = ['src/goosepkg'],
-    data_files = [('/etc/goosepkg', ['src/goosepkg.conf']),]
+    data_files = [('/etc/goosepkg', ['src/goosepkg.conf']),],
+    cmdclass = {'build_py': build_py_registry},
 )
 
 # production directory
@@ -36,9 +36,9 @@ _goosepkg()
 
     local options="--help -v -q"
     local options_value="--dist --user --path"
-    local commands="build chain-build ci clean clog clone co commit compile diff gimmespec giturl help \
+    local commands="build bundle chain-build ci clean clog clone co commit compile diff gimmespec giturl help \
     gitbuildurl import install lint local mockbuild mock-config new new-sources patch prep pull push retire scratch-build sources \
-    srpm switch-branch tag tag-request unused-patches update upload verify-files verrel"
+    srpm switch-branch tag tag-request unused-patches update upload verify-files verrel watch-tasks"
 
     # parse main options and get command
 
@@ -101,6 +101,11 @@ _goosepkg()
             options_srpm="--srpm"
             options_target="--target"
             ;;
+        bundle)
+            options="export import --lookaside-cache"
+            after="file"
+            after_more=true
+            ;;
         chain-build)
             options="--nowait --background"
             options_target="--target"
@@ -114,7 +119,7 @@ _goosepkg()
             options="--raw"
             ;;
         clone|co)
-            options="--branches --anonymous"
+            options="--branches --anonymous --prefetch --no-prefetch"
             options_branch="-b"
             after="package"
             ;;
@@ -184,7 +189,7 @@ _goosepkg()
             options="--md5"
             ;;
         switch-branch)
-            options="--list"
+            options="--list --prefetch --no-prefetch"
             after="branch"
             ;;
         tag)
@@ -196,7 +201,11 @@ _goosepkg()
         tag-request)
             options_string="--desc --build"
             ;;
+        watch-tasks)
+            options_string="--interval --max-interval"
+            ;;
         upload|new-sources)
+            options="--uncompressed-delta"
             after="file"
             after_more=true
             ;;
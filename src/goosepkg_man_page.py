@@ -143,11 +143,7 @@ def generate(parser, subparsers):
 
 
 if __name__ == '__main__':
-    try:
-        import goosepkg
-        client = goosepkg.cli.goosepkgClient(config=None)
-    except ImportError:
-        sys.path.append('src/pygoosepkg')
-        import goosepkg
-        client = goosepkg.cli.goosepkgClient(config=None)
+    # Share the parser setup with the command registry generator
+    import goosepkg_registry
+    client = goosepkg_registry.load_client()
     client.parse_cmdline(manpage = True)
@@ -0,0 +1,138 @@
+# Print the goosepkg command registry from the argparse setup.
+#
+# The registry maps every command name to the register methods which have
+# to be called to build its parser, so that goosepkg only constructs the
+# parser of the command being run.  It is generated from the same parser
+# the man page is.  setup.py's build_py writes it into the build tree, to
+# use it from a source checkout regenerate it whenever a register method
+# is added, renamed or removed:
+#
+#   python src/goosepkg_registry.py > src/pygoosepkg/registry.py
+
+import re
+import sys
+import pprint
+
+
+registry_header = """\
+# registry.py - generated by goosepkg_registry.py, do not edit
+#
+# Maps each goosepkg command to the register methods building its parser,
+# and the client attributes shared between parsers to the method setting
+# them, for the pyrpkg cli with the given digest.
+
+"""
+
+# These commands print the whole command tree and always need all parsers
+full_tree_commands = ['help']
+
+
+def import_pygoosepkg():
+    try:
+        import pygoosepkg
+    except ImportError:
+        sys.path.append('src')
+        import pygoosepkg
+    return pygoosepkg
+
+
+def load_client(registers=None):
+    """Return a goosepkgClient, with every command registered by default"""
+
+    return import_pygoosepkg().cli.goosepkgClient(config=None,
+                                                  registers=registers)
+
+
+def record(client):
+    """Record what each register method of a bare client does
+
+    Runs the full subparser setup with every register method wrapped.
+    Returns the methods in call order, the commands each one added and
+    the client attributes each one set.
+    """
+
+    order = []
+    commands = {}
+    provides = {}
+    add_parser = client.subparsers.add_parser
+
+    def wrap(name, method):
+        def wrapper(*args, **kwargs):
+            if name in order:
+                return method(*args, **kwargs)
+            before = set(vars(client))
+            added = []
+
+            def recording_add_parser(command, **kw):
+                added.append(command)
+                return add_parser(command, **kw)
+
+            client.subparsers.add_parser = recording_add_parser
+            try:
+                return method(*args, **kwargs)
+            finally:
+                client.subparsers.add_parser = add_parser
+                order.append(name)
+                commands[name] = added
+                for attr in set(vars(client)) - before:
+                    provides[attr] = name
+        return wrapper
+
+    for name in dir(client):
+        if name.startswith('register_'):
+            setattr(client, name, wrap(name, getattr(client, name)))
+    # Build the full tree this time around
+    client._registers = None
+    client.setup_subparsers()
+    return order, commands, provides
+
+
+def dependencies(register, provides):
+    """Return the register methods needed to build register's parsers
+
+    Some rpkg parsers use the parsers of other commands as parents, so
+    the register method is tried on a bare client, adding whatever method
+    provides the missing attribute until it succeeds.
+    """
+
+    needed = [register]
+    while True:
+        client = load_client(registers=[])
+        try:
+            for name in needed:
+                getattr(client, name)()
+        except AttributeError, e:
+            match = re.search(r"has no attribute '(\w+)'", str(e))
+            if not match or provides.get(match.group(1)) in (None, register):
+                raise
+            provider = provides[match.group(1)]
+            if provider in needed:
+                raise
+            needed.insert(0, provider)
+        else:
+            return needed
+
+
+def generate(out=sys.stdout):
+    """Write the registry module to out"""
+
+    order, commands, provides = record(load_client(registers=[]))
+    registry = {}
+    for register in order:
+        if not commands[register]:
+            # Disabled rpkg commands don't add a parser
+            continue
+        needed = dependencies(register, provides)
+        for command in commands[register]:
+            if command not in full_tree_commands:
+                registry[command] = needed
+
+    out.write(registry_header)
+    out.write('RPKG_CLI_DIGEST = %r\n' %
+              import_pygoosepkg().cli.rpkg_cli_digest())
+    out.write('COMMANDS = %s\n' % pprint.pformat(registry))
+    out.write('PROVIDES = %s\n' % pprint.pformat(provides))
+
+
+if __name__ == '__main__':
+    generate()
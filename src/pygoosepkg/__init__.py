@@ -13,12 +13,24 @@ import pyrpkg
 from pyrpkg import GitIgnore
 import os
 import re
+import sys
 import cli
 import git
 import stat
+import fcntl
+import pipes
+import shlex
+import Queue
 import pycurl
 import hashlib
 import platform
+import bundle
+import shutil
+import tempfile
+import threading
+import lookaside
+import watch
+import subprocess
 
 
 class goosepkgError(Exception):
@@ -30,7 +42,8 @@ class Commands(pyrpkg.Commands):
                 lookaside_user, lookaside_remote_dir,
                 gitbaseurl, anongiturl, branchre, kojiconfig,
                 build_client, user=None, dist=None, target=None,
-                quiet=False):
+                quiet=False, lookaside_mirrors=None, lookaside_ssh='ssh',
+                uncompressed_delta=False):
         """Init the object and some configuration details."""
 
         # We are subclassing to set kojiconfig to none, so that we can
@@ -44,6 +57,11 @@ class Commands(pyrpkg.Commands):
         self.lookaside_host = lookaside_host
         self.lookaside_user = lookaside_user
         self.lookaside_remote_dir = lookaside_remote_dir
+        self._lookaside_mirrors_conf = lookaside_mirrors
+        # The ssh command used to reach lookaside_host, with any options
+        self.lookaside_ssh = lookaside_ssh
+        # Upload tarballs as deltas of their uncompressed content
+        self.uncompressed_delta = uncompressed_delta
 
         # New data
         self.secondary_arch = {}
@@ -52,6 +70,7 @@ class Commands(pyrpkg.Commands):
         self._kojiconfig = None
         self._cert_file = None
         self._ca_cert = None
+        self._lookaside_mirrors = None
         # Store this for later
         self._orig_kojiconfig = kojiconfig
 
@@ -111,6 +130,29 @@ class Commands(pyrpkg.Commands):
         self._cert_file = os.path.expanduser('~/.koji/goose.cert')
         self._ca_cert = os.path.expanduser('~/.koji/goose-server-ca.cert')
 
+    @property
+    def lookaside_mirrors(self):
+        """This property ensures the lookaside_mirrors attribute"""
+
+        if self._lookaside_mirrors is None:
+            self.load_lookaside_mirrors()
+        return self._lookaside_mirrors
+
+    def load_lookaside_mirrors(self):
+        """This loads the lookaside_mirrors attribute
+
+        Falls back to the lookaside url alone if no mirrors are configured.
+        """
+
+        cache_file = os.path.expanduser('~/.cache/goosepkg/mirrors.json')
+        try:
+            self._lookaside_mirrors = lookaside.MirrorList.from_config(
+                                        self.lookaside,
+                                        self._lookaside_mirrors_conf,
+                                        cache_file=cache_file, log=self.log)
+        except lookaside.MirrorError, e:
+            raise goosepkgError(e)
+
     # Overloaded property loaders
     def load_rpmdefines(self):
         """Populate rpmdefines based on branch data"""
@@ -185,6 +227,19 @@ class Commands(pyrpkg.Commands):
     def build(self, *args, **kwargs):
         return(super(Commands, self).build(*args, **kwargs))
 
+    def watch_tasks(self, task_ids, interval=5, max_interval=60,
+                    session=None):
+        """Watch koji tasks until they are all done
+
+        The tasks are polled through session, the kojisession by default.
+        Returns 0 if all of them succeeded, 1 otherwise.
+        """
+
+        watcher = watch.TaskWatcher(session or self.kojisession, task_ids,
+                                    interval=interval,
+                                    max_interval=max_interval)
+        return watcher.watch()
+
     def _findmasterbranch(self):
         """Find the right "GoOSe" for master"""
 
@@ -325,14 +380,49 @@ class Commands(pyrpkg.Commands):
         input.close()
         return sum.hexdigest()
 
-    def _do_rsync(self, file_hash, filename):
-        """Use curl manually to upload a file"""
+    def _find_basis(self, filename, file_hash, previous):
+        """Find the previous version of filename among the old sources
+
+        previous holds the (checksum, filename) entries the sources file
+        had before this upload.  The last one with the same name stem and
+        archive extension is returned, or None.
+        """
+
+        stem = lookaside.source_stem(filename)
+        basis = None
+        for csum, name in previous:
+            if csum != file_hash and lookaside.source_stem(name) == stem:
+                basis = (csum, name)
+        return basis
 
-        cmd = ["/usr/bin/rsync", "--progress", "-loDtRz", "-e", "ssh",
+    def _do_rsync(self, file_hash, filename, basis=None):
+        """Use rsync to upload a file
+
+        Transfer compression is only used for files which would shrink.
+        Given the (checksum, filename) of the previous version of the file
+        as basis, its copy on the lookaside is used for rsync's delta
+        transfer.
+        """
+
+        flags = "-loDtR"
+        if lookaside.compressible(filename):
+            flags += "z"
+        else:
+            self.log.debug('Not compressing the upload of %s' % filename)
+
+        cmd = ["/usr/bin/rsync", "--progress", flags, "-e", self.lookaside_ssh,
               os.path.basename(filename),
               "{0}@{1}:{2}/{3}/{4}/".format(self.lookaside_user,
               self.lookaside_host, self.lookaside_remote_dir,
               self.module_name, file_hash)]
+        if basis:
+            # Make rsync look for a similarly named file in the previous
+            # version's directory and only send the differences to it.
+            # The receiving rsync only fuzzy matches in --copy-dest
+            # directories from 3.1 on, older ones send the whole file.
+            cmd[3:3] = ["--copy-dest=../%s" % basis[0], "--fuzzy", "--fuzzy"]
+            self.log.debug('Uploading %s as a delta to %s' %
+                           (filename, basis[1]))
 
         actual_dir = os.path.abspath(os.path.dirname(filename))
 
@@ -344,17 +434,16 @@ class Commands(pyrpkg.Commands):
 #        cmd.append(self.lookaside_cgi)
         self._run_command(cmd, cwd=actual_dir)
 
-    def sources(self, outdir=None):
-        """Download source files"""
+    def _read_sources(self, path=None):
+        """Return the (checksum, filename) entries of a sources file"""
 
+        if not path:
+            path = self.path
         try:
-            archives = open(os.path.join(self.path, 'sources'),
-                            'r').readlines()
+            archives = open(os.path.join(path, 'sources'), 'r').readlines()
         except IOError, e:
-            raise rpkgError('%s is not a valid repo: %s' % (self.path, e))
-        # Default to putting the files where the module is
-        if not outdir:
-            outdir = self.path
+            raise goosepkgError('%s is not a valid repo: %s' % (path, e))
+        entries = []
         for archive in archives:
             try:
                 # This strip / split is kind a ugly, but checksums shouldn't have
@@ -362,134 +451,674 @@ class Commands(pyrpkg.Commands):
                 # future
                 csum, file = archive.strip().split('  ', 1)
             except ValueError:
-                raise rpkgError('Malformed sources file.')
-            # See if we already have a valid copy downloaded
-            outfile = os.path.join(outdir, file)
-            if os.path.exists(outfile):
-                if self._verify_file(outfile, csum, self.lookasidehash):
-                    continue
-            self.log.info("Downloading %s" % (file))
-            url = '%s/%s/%s/%s' % (self.lookaside, self.module_name,
-                                      csum, file.replace(' ', '%20'))
+                raise goosepkgError('Malformed sources file.')
+            entries.append((csum, file))
+        return entries
+
+    def _download_source(self, module, csum, file, outfile, mirrors,
+                         quiet=False):
+        """Download a source file, trying each of the mirrors in turn
 
+        A mirror is given up on for this file when the download errors or
+        the result fails the checksum.
+        """
+
+        path = '%s/%s/%s' % (module, csum, file.replace(' ', '%20'))
+        for mirror in mirrors:
             command = ['curl', '-H', 'Pragma:', '-o', outfile, '-R', '-S', '--fail']
-            if self.quiet:
+            # Only ask for a compressed transfer if it could shrink
+            if lookaside.compressible_name(file):
+                command.append('--compressed')
+            if quiet:
                 command.append('-s')
-            command.append(url)
-            self._run_command(command)
-            if not self._verify_file(outfile, csum, self.lookasidehash):
-                raise rpkgError('%s failed checksum' % file)
-        return
+            command.append('%s/%s' % (mirror.url, path))
+            try:
+                self._run_command(command)
+            except pyrpkg.rpkgError, e:
+                self.log.warning('Downloading %s from %s failed: %s' %
+                                 (file, mirror.url, e))
+            else:
+                if self._verify_file(outfile, csum, self.lookasidehash):
+                    return
+                self.log.warning('%s from %s failed checksum' %
+                                 (file, mirror.url))
+            self.lookaside_mirrors.failed(mirror)
+            if os.path.exists(outfile):
+                os.unlink(outfile)
+        raise goosepkgError('%s could not be downloaded from any lookaside '
+                            'mirror' % file)
 
+    def _download_sources(self, module, downloads, quiet=False,
+                          finished=None):
+        """Download (checksum, filename, outfile) entries of module
 
-    #TODO: write a test using ssh to verify the file exists or not
-    def file_exists(self, pkg_name, filename, md5sum):
+        The downloads run in parallel, spread across the healthy lookaside
+        mirrors.  finished, if given, is called with each entry once it is
+        done with, whether it succeeded or not.
         """
-        Return True if the given file exists in the lookaside cache, False
-        if not.
 
-        A goosepkgError will be thrown if the request looks bad or something
-        goes wrong. (i.e. the lookaside URL cannot be reached, or the package
-        named does not exist)
+        # Probe the mirrors with the first file we need
+        mirrors = self.lookaside_mirrors
+        mirrors.rank('%s/%s/%s' % (module, downloads[0][0],
+                                   downloads[0][1].replace(' ', '%20')))
+        workers = min(len(downloads), len(mirrors.healthy()))
+        # Progress bars of parallel downloads would be garbled
+        quiet = quiet or workers > 1
+
+        queue = Queue.Queue()
+        for index, download in enumerate(downloads):
+            queue.put((index, download))
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    index, download = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                csum, file, outfile = download
+                self.log.info("Downloading %s" % (file))
+                try:
+                    self._download_source(module, csum, file, outfile,
+                                          mirrors.order(index), quiet)
+                except Exception, e:
+                    errors.append(e)
+                if finished:
+                    finished(download)
+
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _git_dir(self, path):
+        """Return the git directory of the checkout at path, or None
+
+        The git directory is not necessarily path/.git, worktrees and
+        submodules have a .git file pointing elsewhere.
         """
 
-#        # String buffer, used to receive output from the curl request:
-#        buf = StringIO.StringIO()
-#
-#        # Setup the POST data for lookaside CGI request. The use of
-#        # 'filename' here appears to be what differentiates this
-#        # request from an actual file upload.
-#        post_data = [
-#                ('name', pkg_name),
-#                ('md5sum', md5sum),
-#                ('filename', filename)]
-#
-#        curl = self._create_curl()
-#        curl.setopt(pycurl.WRITEFUNCTION, buf.write)
-#        curl.setopt(pycurl.HTTPPOST, post_data)
-#
-#        try:
-#            curl.perform()
-#        except Exception, e:
-#            raise goosepkgError('Lookaside failure: %s' % e)
-#        curl.close()
-#        output = buf.getvalue().strip()
-#
-#        # Lookaside CGI script returns these strings depending on whether
-#        # or not the file exists:
-#        if output == "Available":
-#            return True
-#        if output == "Missing":
+        try:
+            proc = subprocess.Popen(['git', 'rev-parse', '--git-dir'],
+                                    cwd=path, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except OSError:
+            return None
+        output, error = proc.communicate()
+        if proc.returncode:
+            return None
+        return os.path.join(os.path.abspath(path), output.strip())
 
-#        return False
+    def _prefetch_lock(self, git_dir, file):
+        """Return the lock file held while file is prefetched"""
 
-        # Something unexpected happened, will trigger if the lookaside URL
-        # cannot be reached, the package named does not exist, and probably
-        # some other scenarios as well.
-        #raise goosepkgError("Error checking for %s at: %s" %
-        #        (filename, self.lookaside_cgi))
+        return os.path.join(git_dir, 'goosepkg-prefetch', file)
 
+    def _wait_prefetch(self, git_dir, file):
+        """Wait for a background download of file to finish"""
 
-    def upload(self, files, replace=False):
-        """Upload source file(s) in the lookaside cache
+        lockfile = self._prefetch_lock(git_dir, file)
+        try:
+            lock = open(lockfile, 'r')
+        except IOError:
+            # Not prefetched, or already done with
+            return
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self.log.info("Waiting for background download of %s" % file)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # The prefetch is over, or died and left its lock behind.  A new
+            # prefetch may have replaced the lock meanwhile, leave that be.
+            if self._holds_lock(lock, lockfile):
+                os.unlink(lockfile)
+        finally:
+            lock.close()
+
+    def _holds_lock(self, lock, lockfile):
+        """Return whether the open lock is still the file at lockfile"""
 
-        Can optionally replace the existing tracked sources
+        try:
+            return os.fstat(lock.fileno()).st_ino == os.stat(lockfile).st_ino
+        except OSError:
+            return False
+
+    def _lock_prefetch(self, lockfile):
+        """Lock lockfile for a prefetch, return it or None if taken"""
+
+        while True:
+            lock = open(lockfile, 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Somebody is downloading it already
+                lock.close()
+                return None
+            if self._holds_lock(lock, lockfile):
+                return lock
+            # sources() removed it after we opened it, try again
+            lock.close()
+
+    def prefetch_sources(self, path=None, module=None):
+        """Start downloading the sources of a checkout in the background
+
+        Each file being downloaded stays locked until it is done with, so
+        that sources() waits for the in-flight download instead of
+        starting another one.  Progress goes to goosepkg-prefetch.log in
+        the git directory.
+
+        Returns the pid of the background process, or None if there was
+        nothing to download.
         """
 
-        oldpath = os.getcwd()
-        os.chdir(self.path)
+        if not path:
+            path = self.path
+        if not module:
+            module = self.module_name
+        if not os.path.exists(os.path.join(path, 'sources')):
+            return None
+        git_dir = self._git_dir(path)
+        if not git_dir:
+            self.log.debug('Not prefetching sources, %s is not a git '
+                           'checkout' % path)
+            return None
+        lockdir = os.path.dirname(self._prefetch_lock(git_dir, ''))
+        if not os.path.isdir(lockdir):
+            os.makedirs(lockdir)
+
+        downloads = []
+        locks = {}
+        for csum, file in self._read_sources(path):
+            outfile = os.path.join(path, file)
+            if os.path.exists(outfile):
+                if self._verify_file(outfile, csum, self.lookasidehash):
+                    continue
+            lock = self._lock_prefetch(self._prefetch_lock(git_dir, file))
+            if not lock:
+                continue
+            downloads.append((csum, file, outfile))
+            locks[file] = lock
+        if not downloads:
+            return None
+
+        # The child inherits the locks, so there is no window in which
+        # sources() could miss them.
+        pid = os.fork()
+        if pid:
+            for lock in locks.values():
+                lock.close()
+            self.log.info('Downloading sources in the background (pid %d)'
+                          % pid)
+            return pid
+
+        status = 1
+        try:
+            os.setsid()
+            logfile = os.open(os.path.join(git_dir, 'goosepkg-prefetch.log'),
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(logfile, 1)
+            os.dup2(logfile, 2)
+
+            def finished(download):
+                file = download[1]
+                os.unlink(self._prefetch_lock(git_dir, file))
+                locks[file].close()
 
-        # Decide to overwrite or append to sources:
-        if replace:
-            sources = []
-            sources_file = open('sources', 'w')
-        else:
-            sources = open('sources', 'r').readlines()
-            sources_file = open('sources', 'a')
+            try:
+                self._download_sources(module, downloads, quiet=True,
+                                       finished=finished)
+                status = 0
+            except Exception, e:
+                self.log.error('Background download failed: %s' % e)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _recompress(self, tarball, commands, file_hash):
+        """Return the first compress command reproducing file_hash
+
+        Returns None if none of them gives back the exact same bytes.
+        """
 
-        # Will add new sources to .gitignore if they are not already there.
-        gitignore = GitIgnore(os.path.join(self.path, '.gitignore'))
+        for command in commands:
+            sum = hashlib.new(self.lookasidehash)
+            proc = subprocess.Popen(command + [tarball],
+                                    stdout=subprocess.PIPE)
+            while True:
+                chunk = proc.stdout.read(65536)
+                if not chunk:
+                    break
+                sum.update(chunk)
+            if proc.wait() == 0 and sum.hexdigest() == file_hash:
+                return command
+        return None
 
-        uploaded = []
-        for f in files:
-            # TODO: Skip empty file needed?
-            file_hash = self._hash_file(f, self.lookasidehash)
-            self.log.info("Uploading: %s  %s" % (file_hash, f))
-            file_basename = os.path.basename(f)
+    def _do_uncompressed_delta(self, file_hash, filename, basis):
+        """Upload a compressed tarball as a delta of its tar content
 
-            if not "%s  %s\n" % (file_hash, file_basename) in sources:
-                sources_file.write("%s  %s\n" % (file_hash, file_basename))
+        Small changes to a tarball change most of its compressed bytes,
+        so rsync finds little to reuse.  Instead the old and new tarballs
+        are decompressed, the plain tar is sent as a delta to the old one,
+        and the lookaside host compresses it again.  That only works when
+        compressing gives back the exact same file, which is checked
+        locally first and again on the lookaside host.
 
+        Returns True if the file was uploaded, False if a normal upload is
+        needed.
+        """
 
-            # Add this file to .gitignore if it's not already there:
-            if not gitignore.match(file_basename):
-                gitignore.add('/%s' % file_basename)
+        new = lookaside.tar_compressor(filename)
+        old = lookaside.tar_compressor(basis[1])
+        if not new or not old:
+            return False
 
+        tmpdir = tempfile.mkdtemp(prefix='goosepkg-delta-')
+        try:
+            tarname = os.path.basename(filename)[:-len(new[0])] + '.tar'
+            tarball = os.path.join(tmpdir, tarname)
+            output = open(tarball, 'wb')
+            try:
+                if subprocess.call(new[1] + [filename], stdout=output):
+                    self.log.info('Could not decompress %s, uploading it '
+                                  'whole' % filename)
+                    return False
+            finally:
+                output.close()
+            compress = self._recompress(tarball, new[2], file_hash)
+            if not compress:
+                self.log.info('%s cannot be reproduced from its tar content, '
+                              'uploading it whole' % filename)
+                return False
+
+            staging = '%s/%s/.delta-%s' % (self.lookaside_remote_dir,
+                                           self.module_name, file_hash)
+            quoted_staging = pipes.quote(staging)
+            old_tarname = basis[1][:-len(old[0])] + '.tar'
+            dest_dir = self._remote_source_path(self.module_name, file_hash)
+            dest = self._remote_source_path(self.module_name, file_hash,
+                                            os.path.basename(filename))
+            try:
+                self._run_remote('mkdir -p %s && %s %s > %s/%s' % (
+                            quoted_staging, ' '.join(old[1]),
+                            self._remote_source_path(self.module_name, *basis),
+                            quoted_staging, pipes.quote(old_tarname)))
+
+                flags = "-loDt"
+                if lookaside.compressible(tarball):
+                    flags += "z"
+                cmd = ["/usr/bin/rsync", "--progress", flags, "--fuzzy",
+                       "-e", self.lookaside_ssh, tarname,
+                       "{0}@{1}:{2}/".format(self.lookaside_user,
+                                             self.lookaside_host, staging)]
+                self.log.debug('Uploading %s as a delta to %s' %
+                               (tarname, old_tarname))
+                self._run_command(cmd, cwd=tmpdir)
+
+                # Only move the result into place if it is the same file
+                reply = self._run_remote(
+                    'mkdir -p %(dir)s && %(compress)s %(staging)s/%(tar)s >'
+                    ' %(dest)s.part && test "$(%(hash)ssum < %(dest)s.part |'
+                    ' cut -d" " -f1)" = %(file_hash)s &&'
+                    ' mv %(dest)s.part %(dest)s && echo ok;'
+                    ' rm -rf %(staging)s %(dest)s.part' % {
+                        'dir': dest_dir, 'dest': dest,
+                        'compress': ' '.join(compress),
+                        'staging': quoted_staging,
+                        'tar': pipes.quote(tarname),
+                        'hash': self.lookasidehash,
+                        'file_hash': file_hash})
+                if reply.strip() != 'ok':
+                    self.log.info('The lookaside host could not reproduce %s, '
+                                  'uploading it whole' % filename)
+                    return False
+                return True
+            except (goosepkgError, pyrpkg.rpkgError), e:
+                self.log.info('Delta upload of %s failed, uploading it whole: '
+                              '%s' % (filename, e))
+                try:
+                    self._run_remote('rm -rf %s' % quoted_staging)
+                except goosepkgError:
+                    pass
+                return False
+        finally:
+            shutil.rmtree(tmpdir)
 
-            if self.file_exists(self.module_name, file_basename, file_hash):
-                # Already uploaded, skip it:
-                self.log.info("File already uploaded: %s" % file_basename)
-            else:
-                # Ensure the new file is readable:
-                os.chmod(f, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-                #lookaside.upload_file(self.module, f, file_hash)
-                # For now don't use the pycurl upload function as it does
-                # not produce any progress output.  Cheat and use curl
-                # directly.
-                self._do_rsync(file_hash, f)
-                uploaded.append(file_basename)
+    def sources(self, outdir=None):
+        """Download source files
+
+        Files still being downloaded by prefetch_sources() are waited for
+        rather than downloaded again.
+        """
+
+        # Default to putting the files where the module is
+        if not outdir:
+            outdir = self.path
+        downloads = []
+        git_dir = self._git_dir(self.path)
+        for csum, file in self._read_sources():
+            if git_dir:
+                self._wait_prefetch(git_dir, file)
+            # See if we already have a valid copy downloaded
+            outfile = os.path.join(outdir, file)
+            if os.path.exists(outfile):
+                if self._verify_file(outfile, csum, self.lookasidehash):
+                    continue
+            downloads.append((csum, file, outfile))
+        if not downloads:
+            return
+        self._download_sources(self.module_name, downloads, quiet=self.quiet)
+        return
+
+    def _fetch(self, url, write):
+        """Stream url into write, raising pycurl.error on failure"""
+
+        mirrors = self.lookaside_mirrors
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.FAILONERROR, 1)
+        curl.setopt(pycurl.CONNECTTIMEOUT, mirrors.probe_timeout)
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, mirrors.stall_speed)
+        curl.setopt(pycurl.LOW_SPEED_TIME, mirrors.stall_time)
+        curl.setopt(pycurl.HTTPHEADER, ['Pragma:'])
+        curl.setopt(pycurl.WRITEFUNCTION, write)
+        try:
+            curl.perform()
+        finally:
+            curl.close()
+
+    def _bundle_download(self, writer, module, csum, file, index):
+        """Stream the index'th source file into a bundle from the mirrors"""
+
+        mirrors = self.lookaside_mirrors
+        urlpath = '%s/%s/%s' % (module, csum, file.replace(' ', '%20'))
+        mirrors.rank(urlpath)
+        self.log.info("Downloading %s" % (file))
+        for mirror in mirrors.order(index):
+            url = '%s/%s' % (mirror.url, urlpath)
+            try:
+                writer.write(csum, lambda write: self._fetch(url, write))
+                return
+            except (pycurl.error, bundle.BundleError), e:
+                self.log.warning('Downloading %s from %s failed: %s' %
+                                 (file, mirror.url, e))
+                mirrors.failed(mirror)
+        raise goosepkgError('%s could not be downloaded from any lookaside '
+                            'mirror' % file)
+
+    def bundle_export(self, bundle_file, paths):
+        """Pack the sources of the module checkouts in paths into a bundle
+
+        The module name of each checkout is taken from its directory name,
+        as clone names them.  Files present and valid in a checkout are
+        read from there, the others are streamed from the lookaside mirrors
+        straight into the bundle.  Content shared between modules is only
+        stored once.
+        """
+
+        writer = bundle.BundleWriter(bundle_file, self.lookasidehash)
+        try:
+            for path in paths:
+                module = os.path.basename(os.path.abspath(path))
+                for index, (csum, file) in enumerate(self._read_sources(path)):
+                    if csum not in writer:
+                        local = os.path.join(path, file)
+                        if os.path.exists(local) and self._verify_file(
+                                local, csum, self.lookasidehash):
+                            writer.write_file(csum, local)
+                        else:
+                            self._bundle_download(writer, module, csum, file,
+                                                  index)
+                    writer.add(module, csum, file)
+        except:
+            # A bundle missing files is worse than none
+            writer.abort()
+            raise
+        writer.close()
+        self.log.info('Bundled %d files of %d modules into %s' %
+                      (len(writer.objects), len(writer.modules), bundle_file))
+
+    def bundle_import(self, bundle_file, paths=None, cache=None):
+        """Unpack a bundle into module checkouts and/or a lookaside cache
+
+        Every object is verified in one pass over the bundle first.  The
+        checkouts in paths get the files their sources file names, while
+        cache is filled with every module in the bundle using the
+        lookaside layout <module>/<hash>/<file>.  Files are written in
+        bundle order, so the bundle is read sequentially.
+        """
+
+        try:
+            reader = bundle.BundleReader(bundle_file)
+        except bundle.BundleError, e:
+            raise goosepkgError(e)
+        try:
+            if reader.hashtype != self.lookasidehash:
+                raise goosepkgError('%s uses %s checksums, not %s' %
+                                    (bundle_file, reader.hashtype,
+                                     self.lookasidehash))
+            bad = reader.verify()
+            if bad:
+                raise goosepkgError('%s is corrupt, failed checksums: %s' %
+                                    (bundle_file, ' '.join(bad)))
+
+            # (checksum, output file) pairs to write
+            outputs = []
+            if cache:
+                for module, entries in reader.modules.items():
+                    for csum, file in entries:
+                        if csum not in reader:
+                            self.log.warning('%s of %s is not in %s' %
+                                             (file, module, bundle_file))
+                            continue
+                        outputs.append((csum, os.path.join(cache, module,
+                                                           csum, file)))
+            for path in paths or []:
+                for csum, file in self._read_sources(path):
+                    outfile = os.path.join(path, file)
+                    if csum not in reader:
+                        self.log.warning('%s is not in %s' %
+                                         (file, bundle_file))
+                    elif not (os.path.exists(outfile) and self._verify_file(
+                                    outfile, csum, self.lookasidehash)):
+                        outputs.append((csum, outfile))
+
+            outputs.sort(key=lambda output: reader.objects[output[0]][0])
+            for csum, outfile in outputs:
+                self.log.debug('Extracting %s' % outfile)
+                reader.extract(csum, outfile)
+        finally:
+            reader.close()
+        self.log.info('Extracted %d files from %s' % (len(outputs),
+                                                      bundle_file))
+
+    def _run_remote(self, script):
+        """Run a shell script on the lookaside host and return its output"""
+
+        cmd = shlex.split(self.lookaside_ssh)
+        cmd.extend(['%s@%s' % (self.lookaside_user, self.lookaside_host),
+                    script])
+        self.log.debug('Running on %s: %s' % (self.lookaside_host, script))
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output, error = proc.communicate()
+        if proc.returncode:
+            raise goosepkgError('Lookaside failure: %s' % error.strip())
+        return output
+
+    def _remote_source_path(self, module, file_hash, filename=None):
+        """Return the quoted path of a source (dir) on the lookaside host"""
+
+        parts = [self.lookaside_remote_dir, module, file_hash]
+        if filename:
+            parts.append(filename)
+        return '/'.join(pipes.quote(part) for part in parts)
+
+    def file_exists(self, pkg_name, filename, md5sum):
+        """
+        Return True if the given file exists in the lookaside cache, False
+        if not.
 
+        A goosepkgError will be thrown if the lookaside host cannot be
+        reached.
+        """
+
+        output = self._run_remote('test -f %s && echo Available || '
+                                  'echo Missing' % self._remote_source_path(
+                                                pkg_name, md5sum, filename))
+        return output.strip() == 'Available'
+
+    def link_existing(self, sources):
+        """Reuse content already in the lookaside cache under any module
+
+        sources is a list of (hash, filename, size, sha256) tuples.  Files
+        already uploaded for this module are left alone, others whose
+        content is stored for another module are hard linked into place on
+        the lookaside host, so their bytes are not transferred again.  As
+        the lookaside hash may be weak, a copy is only linked when its
+        sha256 matches too.
 
-        sources_file.close()
+        Returns a dict mapping each filename to 'exists', 'linked' or
+        'missing'.
+        """
 
-        # Write .gitignore with the new sources if anything changed:
-        gitignore.write()
+        script = []
+        for file_hash, filename, size, sha256 in sources:
+            dest_dir = self._remote_source_path(self.module_name, file_hash)
+            dest = self._remote_source_path(self.module_name, file_hash,
+                                            filename)
+            # Any module's copy of the same content will do
+            candidates = '%s/*/%s/*' % (pipes.quote(self.lookaside_remote_dir),
+                                        pipes.quote(file_hash))
+            script.append(
+                '(test -f %(dest)s && echo exists || {'
+                ' for src in %(candidates)s; do'
+                ' test -f "$src" || continue;'
+                ' test "$(stat -c %%s "$src")" = %(size)d || continue;'
+                ' test "$(sha256sum < "$src" | cut -d" " -f1)" = %(sha256)s'
+                ' || continue;'
+                ' mkdir -p %(dest_dir)s && ln "$src" %(dest)s &&'
+                ' echo linked && exit 0;'
+                ' done; echo missing; })' % {'dest': dest,
+                                             'dest_dir': dest_dir,
+                                             'candidates': candidates,
+                                             'size': size,
+                                             'sha256': pipes.quote(sha256)})
+        output = self._run_remote('; '.join(script)).split()
+        if len(output) != len(sources):
+            raise goosepkgError('Unexpected lookaside reply: %s' %
+                                ' '.join(output))
+        return dict((source[1], status)
+                    for source, status in zip(sources, output))
 
-        rv = self.repo.index.add(['sources', '.gitignore'])
+    def upload(self, files, replace=False):
+        """Upload source file(s) in the lookaside cache
 
-        # Change back to original working dir:
-        os.chdir(oldpath)
+        Can optionally replace the existing tracked sources
+        """
+
+        oldpath = os.getcwd()
+        os.chdir(self.path)
+        try:
+            # The old entries tell where to find bases for delta uploads,
+            # even when they are being replaced
+            previous = []
+            if os.path.exists('sources'):
+                try:
+                    previous = self._read_sources()
+                except goosepkgError, e:
+                    # Replacing a broken sources file is how it gets fixed
+                    self.log.debug('Not using the old sources for delta '
+                                   'uploads: %s' % e)
+
+            hashes = {}
+            for f in files:
+                # TODO: Skip empty file needed?
+                hashes[f] = self._hash_file(f, self.lookasidehash)
+
+            # Find what is already on the lookaside, for any module, at once.
+            # This is only an optimization, so carry on uploading everything
+            # if it fails.
+            try:
+                remote = self.link_existing([(hashes[f], os.path.basename(f),
+                                              os.path.getsize(f),
+                                              self._hash_file(f, 'sha256'))
+                                             for f in files])
+            except goosepkgError, e:
+                self.log.warning('Could not check the lookaside for existing '
+                                 'files: %s' % e)
+                remote = dict((os.path.basename(f), 'missing')
+                              for f in files)
+
+            # Decide to overwrite or append to sources:
+            if replace:
+                sources = []
+                sources_file = open('sources', 'w')
+            else:
+                sources = open('sources', 'r').readlines()
+                sources_file = open('sources', 'a')
+
+            # Will add new sources to .gitignore if they are not already there.
+            gitignore = GitIgnore(os.path.join(self.path, '.gitignore'))
+
+            uploaded = []
+            linked = []
+            for f in files:
+                file_hash = hashes[f]
+                self.log.info("Uploading: %s  %s" % (file_hash, f))
+                file_basename = os.path.basename(f)
+
+                if not "%s  %s\n" % (file_hash, file_basename) in sources:
+                    sources_file.write("%s  %s\n" % (file_hash, file_basename))
+
+
+                # Add this file to .gitignore if it's not already there:
+                if not gitignore.match(file_basename):
+                    gitignore.add('/%s' % file_basename)
+
+
+                if remote[file_basename] == 'exists':
+                    # Already uploaded, skip it:
+                    self.log.info("File already uploaded: %s" % file_basename)
+                elif remote[file_basename] == 'linked':
+                    self.log.info("File already in the lookaside for another "
+                                  "module, linked: %s" % file_basename)
+                    linked.append(file_basename)
+                else:
+                    # Ensure the new file is readable:
+                    os.chmod(f, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    #lookaside.upload_file(self.module, f, file_hash)
+                    # For now don't use the pycurl upload function as it does
+                    # not produce any progress output.  Cheat and use curl
+                    # directly.
+                    basis = self._find_basis(file_basename, file_hash,
+                                             previous)
+                    if not (basis and self.uncompressed_delta and
+                            self._do_uncompressed_delta(file_hash, f, basis)):
+                        self._do_rsync(file_hash, f, basis)
+                    uploaded.append(file_basename)
+
+
+            sources_file.close()
+
+            # Write .gitignore with the new sources if anything changed:
+            gitignore.write()
+
+            rv = self.repo.index.add(['sources', '.gitignore'])
+        finally:
+            # Change back to original working dir:
+            os.chdir(oldpath)
 
         # Log some info
         self.log.info('Uploaded and added to .gitignore: %s' %
                       ' '.join(uploaded))
+        if linked:
+            self.log.info('Linked on the lookaside and added to .gitignore: '
+                          '%s' % ' '.join(linked))
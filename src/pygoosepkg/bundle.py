@@ -0,0 +1,214 @@
+# bundle.py - packed source bundles for goosepkg
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# A bundle holds the source files of many modules in one file, for seeding
+# build hosts or offline sites.  Files are stored once per checksum, one
+# after the other, and an index at the end maps checksums to their offset
+# and size and lists the (checksum, filename) entries of each module:
+#
+#   header   magic, index offset, index size
+#   objects  the file contents, back to back
+#   index    JSON
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+
+
+MAGIC = 'GPKGBNDL'
+HEADER = '>8sQQ'
+HEADER_SIZE = struct.calcsize(HEADER)
+CHUNK_SIZE = 1048576
+
+
+class BundleError(Exception):
+    pass
+
+
+def safe_name(name):
+    """Return whether name is usable as a single path component
+
+    Names in the index of a bundle from elsewhere end up in paths, so
+    they must not climb out of the directory they are written to.
+    """
+
+    return isinstance(name, basestring) and name != '' and \
+        not os.path.isabs(name) and os.sep not in name and \
+        '/' not in name and '..' not in name and '\0' not in name
+
+
+class BundleWriter(object):
+    """Stream source files into a new bundle"""
+
+    def __init__(self, path, hashtype):
+        self.path = path
+        self.hashtype = hashtype
+        self.objects = {}
+        self.modules = {}
+        self.fd = open(path, 'wb')
+        # Filled in once the index is written
+        self.fd.write(struct.pack(HEADER, MAGIC, 0, 0))
+
+    def __contains__(self, csum):
+        return csum in self.objects
+
+    def add(self, module, csum, filename):
+        """Record that module's sources file names csum as filename"""
+
+        self.modules.setdefault(module, []).append([csum, filename])
+
+    def write(self, csum, fill):
+        """Append the object csum, whose data fill(write) produces
+
+        The data is checked against csum as it streams in, and dropped
+        again if it does not match or fill raises.
+        """
+
+        offset = self.fd.tell()
+        sum = hashlib.new(self.hashtype)
+
+        def write(data):
+            sum.update(data)
+            self.fd.write(data)
+
+        try:
+            fill(write)
+            if sum.hexdigest() != csum:
+                raise BundleError('%s failed checksum' % csum)
+        except:
+            self.fd.seek(offset)
+            self.fd.truncate()
+            raise
+        self.objects[csum] = [offset, self.fd.tell() - offset]
+
+    def write_file(self, csum, path):
+        """Append the object csum from a local file"""
+
+        def fill(write):
+            input = open(path, 'rb')
+            try:
+                while True:
+                    chunk = input.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    write(chunk)
+            finally:
+                input.close()
+
+        self.write(csum, fill)
+
+    def close(self):
+        """Write the index and header, completing the bundle"""
+
+        index = json.dumps({'hashtype': self.hashtype,
+                            'objects': self.objects,
+                            'modules': self.modules})
+        offset = self.fd.tell()
+        self.fd.write(index)
+        self.fd.seek(0)
+        self.fd.write(struct.pack(HEADER, MAGIC, offset, len(index)))
+        self.fd.close()
+
+    def abort(self):
+        """Drop the unfinished bundle"""
+
+        self.fd.close()
+        os.unlink(self.path)
+
+
+class BundleReader(object):
+    """Random access to the objects of a bundle through a memory map"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.fd.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            magic, offset, size = struct.unpack(HEADER,
+                                                self.map[:HEADER_SIZE])
+            if magic != MAGIC or offset + size > len(self.map):
+                raise BundleError('%s is not a source bundle' % path)
+            index = json.loads(self.map[offset:offset + size])
+        except (mmap.error, struct.error, ValueError), e:
+            self.fd.close()
+            raise BundleError('%s is not a source bundle: %s' % (path, e))
+        try:
+            self.hashtype = index['hashtype']
+            self.objects = index['objects']
+            self.modules = index['modules']
+            names = []
+            for module, entries in self.modules.items():
+                names.append(module)
+                for csum, filename in entries:
+                    names.extend([csum, filename])
+        except (KeyError, TypeError, ValueError, AttributeError), e:
+            self.close()
+            raise BundleError('%s has a malformed index: %s' % (path, e))
+        unsafe = [name for name in names if not safe_name(name)]
+        if unsafe:
+            self.close()
+            raise BundleError('%s names unsafe paths: %s' %
+                              (path, ', '.join(repr(name)
+                                               for name in unsafe)))
+
+    def __contains__(self, csum):
+        return csum in self.objects
+
+    def by_offset(self, csums=None):
+        """Return csums, all objects by default, in on-disk order"""
+
+        if csums is None:
+            csums = self.objects.keys()
+        return sorted(csums, key=lambda csum: self.objects[csum][0])
+
+    def chunks(self, csum):
+        """Yield the data of object csum in chunks"""
+
+        offset, size = self.objects[csum]
+        for start in xrange(offset, offset + size, CHUNK_SIZE):
+            yield self.map[start:min(start + CHUNK_SIZE, offset + size)]
+
+    def verify(self):
+        """Check every object against its checksum, in one pass
+
+        Returns the checksums which do not match.
+        """
+
+        bad = []
+        for csum in self.by_offset():
+            sum = hashlib.new(self.hashtype)
+            for chunk in self.chunks(csum):
+                sum.update(chunk)
+            if sum.hexdigest() != csum:
+                bad.append(csum)
+        return bad
+
+    def extract(self, csum, path):
+        """Write object csum to path"""
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        partial = '%s.part' % path
+        output = open(partial, 'wb')
+        try:
+            for chunk in self.chunks(csum):
+                output.write(chunk)
+        finally:
+            output.close()
+        os.rename(partial, path)
+
+    def close(self):
+        self.map.close()
+        self.fd.close()
@@ -10,6 +10,7 @@
 # the full text of the license.
 
 from pyrpkg.cli import cliClient
+from pyrpkg import rpkgError
 import sys
 import os
 import logging
@@ -18,14 +19,55 @@ import re
 import textwrap
 import hashlib
 
+# The command registry is generated at build time by goosepkg_registry.py,
+# without it the whole command tree is built on every run.
+try:
+    import registry
+except ImportError:
+    registry = None
+
+
+def rpkg_cli_digest():
+    """Return a digest identifying the installed pyrpkg cli
+
+    The command registry records pyrpkg's register methods and the parsers
+    they share, so it only holds for the pyrpkg it was generated with.
+    """
+
+    import pyrpkg.cli
+    source = os.path.splitext(pyrpkg.cli.__file__)[0] + '.py'
+    if not os.path.exists(source):
+        source = pyrpkg.cli.__file__
+    try:
+        return hashlib.md5(open(source, 'rb').read()).hexdigest()
+    except IOError:
+        return None
+
+
+def ci_mode():
+    """Return whether we are running under continuous integration
+
+    Most CI systems set CI in the environment.
+    """
+
+    return os.environ.get('CI', '').lower() not in ('', '0', 'false', 'no')
+
 
 class goosepkgClient(cliClient):
 
-    def __init__(self, config, name='goosepkg'):
+    def __init__(self, config, name='goosepkg', lazy=False, registers=None):
+        """Init the client
 
-        super(goosepkgClient, self).__init__(config, name)
+        With lazy set, only the parser of the command found on the command
+        line is built, using the generated command registry.  registers
+        can instead name the register methods to call explicitly.
+        """
 
-        self.setup_goose_subparsers()
+        # These are needed by setup_subparsers, called from the rpkg init
+        self._lazy = lazy
+        self._registers = registers
+
+        super(goosepkgClient, self).__init__(config, name)
 
     def load_cmd(self):
         """This sets up the cmd object"""
@@ -56,7 +98,84 @@ class goosepkgClient(cliClient):
                                        user=self.args.user,
                                        dist=self.args.dist,
                                        target=target,
-                                       quiet=self.args.q)
+                                       quiet=self.args.q,
+                                       lookaside_mirrors=items.get(
+                                                    'lookaside_mirrors'),
+                                       lookaside_ssh=items.get(
+                                                    'lookaside_ssh', 'ssh'),
+                                       uncompressed_delta=getattr(self.args,
+                                                    'uncompressed_delta',
+                                                    False))
+
+    def setup_subparsers(self):
+        """Register the subcommands
+
+        Either the register methods picked at init time are called, or the
+        whole rpkg and goose command tree is built.
+        """
+
+        if self._registers is None and self._lazy:
+            self._registers = self.lookup_registers(sys.argv[1:])
+        if self._registers is None:
+            super(goosepkgClient, self).setup_subparsers()
+            self.setup_goose_subparsers()
+            return
+        try:
+            for register in self._registers:
+                getattr(self, register)()
+        except AttributeError, e:
+            # A register method or a parent parser missing means the registry
+            # does not match this pyrpkg, start over and build the whole tree.
+            # Anything else is a bug in the register method itself.
+            if not self.registry_mismatch(e):
+                raise
+            self.subparsers._name_parser_map.clear()
+            del self.subparsers._choices_actions[:]
+            self._registers = None
+            super(goosepkgClient, self).setup_subparsers()
+            self.setup_goose_subparsers()
+
+    def registry_mismatch(self, error):
+        """Return whether an AttributeError comes from a stale registry
+
+        That is when the attribute missing on the client is a register
+        method, or a parser the registry knows another method to provide.
+        """
+
+        match = re.search(r"^'%s' object has no attribute '(\w+)'$" %
+                          type(self).__name__, str(error))
+        if not match:
+            return False
+        name = match.group(1)
+        return name.startswith('register_') or \
+            name in getattr(registry, 'PROVIDES', {})
+
+    def lookup_registers(self, argv):
+        """Return the register methods needed by the command in argv
+
+        Returns None if there is no command registry, it was generated for
+        another pyrpkg or the command is not in it, in which case the full
+        command tree has to be built.
+        """
+
+        if registry is None:
+            return None
+        if getattr(registry, 'RPKG_CLI_DIGEST', None) != rpkg_cli_digest():
+            return None
+        # Global options taking a value must not be mistaken for the command
+        takes_value = set()
+        for action in self.parser._actions:
+            if action.option_strings and action.nargs != 0:
+                takes_value.update(action.option_strings)
+        skip = False
+        for arg in argv:
+            if skip:
+                skip = False
+            elif arg.startswith('-'):
+                skip = arg in takes_value
+            else:
+                return registry.COMMANDS.get(arg)
+        return None
 
     def setup_goose_subparsers(self):
         """Register the goose specific targets"""
@@ -69,6 +188,8 @@ class goosepkgClient(cliClient):
 
         # register updated/new functions
         self.register_clone()
+        self.register_watch_tasks()
+        self.register_bundle()
 
     # Disable some registered commands from rpkg
     def register_mock_config(self):
@@ -105,6 +226,7 @@ class goosepkgClient(cliClient):
         # store the module to be cloned
         clone_parser.add_argument('module', nargs = 1,
                                   help = 'Name of the module to clone')
+        self.add_prefetch_arguments(clone_parser)
         clone_parser.set_defaults(command = self.clone)
 
         # Add an alias for historical reasons
@@ -119,10 +241,184 @@ class goosepkgClient(cliClient):
                                           copy.')
         co_parser.set_defaults(command = self.clone)
 
+    def register_watch_tasks(self):
+        """Register the watch-tasks target"""
+
+        watch_parser = self.subparsers.add_parser('watch-tasks',
+                                         help = 'Watch many koji tasks at once',
+                                         description = 'This command will \
+                                         watch the given koji tasks until \
+                                         they are all done, polling the hub \
+                                         in batches and less often while \
+                                         nothing changes.  It exits non-zero \
+                                         if any of the tasks did not succeed.')
+        watch_parser.add_argument('--interval', type = int, default = 5,
+                                  help = 'Seconds between polls while tasks \
+                                  are changing state')
+        watch_parser.add_argument('--max-interval', type = int, default = 60,
+                                  help = 'Longest wait between polls')
+        watch_parser.add_argument('task_id', nargs = '+',
+                                  help = 'Koji task id to watch, - reads \
+                                  whitespace separated ids from stdin')
+        watch_parser.set_defaults(command = self.watch_tasks)
+
+    def register_bundle(self):
+        """Register the bundle target and its export and import commands"""
+
+        bundle_parser = self.subparsers.add_parser('bundle',
+                                         help = 'Pack sources of many modules \
+                                         into one file',
+                                         description = 'This command will \
+                                         export the sources of many module \
+                                         checkouts into a single indexed \
+                                         bundle file, or import one into \
+                                         checkouts or a local lookaside \
+                                         cache, for seeding build hosts and \
+                                         offline sites.')
+        bundle_subparsers = bundle_parser.add_subparsers(
+                                         title = 'Bundle commands')
+
+        export_parser = bundle_subparsers.add_parser('export',
+                                         help = 'Write a source bundle',
+                                         description = 'Bundle the files \
+                                         named by the sources file of each \
+                                         checkout, downloading the ones \
+                                         not present.  The module name is \
+                                         taken from the checkout directory.')
+        export_parser.add_argument('bundle', help = 'Bundle file to write')
+        export_parser.add_argument('checkouts', nargs = '*',
+                                   help = 'Module checkouts to bundle, \
+                                   defaults to the current one')
+        export_parser.set_defaults(command = self.bundle_export)
+
+        import_parser = bundle_subparsers.add_parser('import',
+                                         help = 'Unpack a source bundle',
+                                         description = 'Verify a bundle and \
+                                         unpack it into module checkouts \
+                                         and/or a local lookaside cache.')
+        import_parser.add_argument('--lookaside-cache', metavar = 'DIR',
+                                   help = 'Unpack every module into DIR \
+                                   using the lookaside layout')
+        import_parser.add_argument('bundle', help = 'Bundle file to read')
+        import_parser.add_argument('checkouts', nargs = '*',
+                                   help = 'Module checkouts to unpack the \
+                                   sources into, defaults to the current \
+                                   one unless --lookaside-cache is given')
+        import_parser.set_defaults(command = self.bundle_import)
+
+    def register_switch_branch(self):
+        """Register the switch-branch target with source prefetching"""
+
+        super(goosepkgClient, self).register_switch_branch()
+        self.add_prefetch_arguments(self.subparsers.choices['switch-branch'])
+
+    def register_upload(self):
+        """Register the upload target with the delta upload option"""
+
+        super(goosepkgClient, self).register_upload()
+        self.add_delta_arguments(self.subparsers.choices['upload'])
+
+    def register_new_sources(self):
+        """Register the new-sources target with the delta upload option"""
+
+        super(goosepkgClient, self).register_new_sources()
+        self.add_delta_arguments(self.subparsers.choices['new-sources'])
+
+    def add_delta_arguments(self, parser):
+        """Add the option to upload tarballs as uncompressed deltas"""
+
+        parser.add_argument('--uncompressed-delta', action = 'store_true',
+                            help = 'Upload a new version of a compressed \
+                            tarball as a delta of the uncompressed content \
+                            of the previous one, if the lookaside can \
+                            reproduce the compressed file exactly')
+
+    def add_prefetch_arguments(self, parser):
+        """Add the options to download sources in the background"""
+
+        parser.add_argument('--prefetch', action = 'store_true',
+                            default = None,
+                            help = 'Start downloading the sources in the \
+                            background once the branch is checked out.  \
+                            This is the default in CI environments.')
+        parser.add_argument('--no-prefetch', action = 'store_false',
+                            dest = 'prefetch',
+                            help = 'Do not download the sources in the \
+                            background')
+
+    def prefetch_wanted(self):
+        """Return whether sources should be prefetched for this run"""
+
+        if self.args.prefetch is None:
+            return ci_mode()
+        return self.args.prefetch
+
+    def prefetch_sources(self, path=None, module=None):
+        """Start prefetching sources, warning only if that fails
+
+        The command itself already succeeded, and sources can still be
+        downloaded later.
+        """
+
+        try:
+            self.cmd.prefetch_sources(path=path, module=module)
+        except Exception, e:
+            self.cmd.log.warning('Could not prefetch sources: %s' % e)
+
     # Target functions go here
     def clone(self):
         self.cmd.clone(self.args.module[0], branch=self.args.branch,
                        anon=self.args.anonymous)
+        if self.prefetch_wanted():
+            self.prefetch_sources(path=os.path.join(self.args.path,
+                                                    self.args.module[0]),
+                                  module=self.args.module[0])
+
+    def bundle_export(self):
+        self.cmd.bundle_export(self.args.bundle,
+                               self.args.checkouts or [self.args.path])
+
+    def bundle_import(self):
+        checkouts = self.args.checkouts
+        if not checkouts and not self.args.lookaside_cache:
+            checkouts = [self.args.path]
+        self.cmd.bundle_import(self.args.bundle, paths=checkouts,
+                               cache=self.args.lookaside_cache)
+
+    def watch_tasks(self):
+        task_ids = []
+        for task_id in self.args.task_id:
+            if task_id == '-':
+                task_ids.extend(sys.stdin.read().split())
+            else:
+                task_ids.append(task_id)
+        try:
+            task_ids = [int(task_id) for task_id in task_ids]
+        except ValueError, e:
+            raise rpkgError('Invalid task id: %s' % e)
+        return self._watch_koji_tasks(self.cmd.kojisession, task_ids)
+
+    def _watch_koji_tasks(self, session, tasks):
+        """Watch koji tasks for completion, all from one polling loop"""
+
+        if not tasks:
+            return 0
+        interval = getattr(self.args, 'interval', 5)
+        max_interval = getattr(self.args, 'max_interval', 60)
+        try:
+            return self.cmd.watch_tasks(tasks, interval=interval,
+                                        max_interval=max_interval,
+                                        session=session)
+        except KeyboardInterrupt:
+            self.cmd.log.info('\nTasks still running. You can continue to '
+                              'watch with the \'%s watch-tasks\' command.'
+                              % self.name)
+            return 1
+
+    def switch_branch(self):
+        super(goosepkgClient, self).switch_branch()
+        if getattr(self.args, 'branch', None) and self.prefetch_wanted():
+            self.prefetch_sources()
 
 if __name__ == '__main__':
     client = cliClient()
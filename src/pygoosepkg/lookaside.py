@@ -0,0 +1,351 @@
+# lookaside.py - lookaside cache mirror handling for goosepkg
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+import os
+import re
+import json
+import math
+import time
+import pycurl
+import threading
+
+
+# Files with these extensions are already compressed, compressing them
+# again for the transfer only costs CPU time.
+compressed_extensions = ('.gz', '.tgz', '.xz', '.txz', '.bz2', '.tbz',
+                         '.tbz2', '.lz', '.lzma', '.z', '.zip', '.7z',
+                         '.zst', '.jar', '.gem', '.crate', '.whl', '.rpm',
+                         '.png', '.jpg', '.jpeg', '.gif')
+
+# Compressed tarball extensions, the command to decompress them and the
+# commands tried in turn to reproduce them from the plain tarball.
+tar_compressors = (
+    ('.tar.gz', ['gzip', '-dc'], [['gzip', '-nc'], ['gzip', '-9nc']]),
+    ('.tgz', ['gzip', '-dc'], [['gzip', '-nc'], ['gzip', '-9nc']]),
+    ('.tar.bz2', ['bzip2', '-dc'], [['bzip2', '-c']]),
+    ('.tar.xz', ['xz', '-dc'], [['xz', '-c'], ['xz', '-9c']]),
+    ('.txz', ['xz', '-dc'], [['xz', '-c'], ['xz', '-9c']]),
+)
+
+# Samples with more bits of entropy per byte than this hardly compress
+entropy_threshold = 7.5
+
+
+def entropy(data):
+    """Return the Shannon entropy of data in bits per byte"""
+
+    if not data:
+        return 0.0
+    size = float(len(data))
+    bits = 0.0
+    for byte in range(256):
+        count = data.count(chr(byte))
+        if count:
+            p = count / size
+            bits -= p * math.log(p, 2)
+    return bits
+
+
+def compressible_name(filename):
+    """Return whether filename does not look like compressed data"""
+
+    return not filename.lower().endswith(compressed_extensions)
+
+
+def source_stem(filename):
+    """Return the name stem and archive extension of a source file
+
+    foo-1.2.tar.xz gives ('foo', '.tar.xz'), so that different versions of
+    the same source can be matched up.
+    """
+
+    match = re.search(r'(\.tar)?\.[A-Za-z0-9]+$', filename)
+    if match:
+        name, ext = filename[:match.start()], match.group(0)
+    else:
+        name, ext = filename, ''
+    return re.sub(r'[-_]v?\d[\w.~+]*$', '', name), ext
+
+
+def tar_compressor(filename):
+    """Return the tar_compressors entry for filename, or None"""
+
+    for entry in tar_compressors:
+        if filename.endswith(entry[0]):
+            return entry
+    return None
+
+
+def compressible(path, sample_size=65536):
+    """Return whether compressing path for a transfer is worth it
+
+    Besides the name, samples from the start, middle and end of the file
+    are checked, so compressed data with an unusual name is caught too.
+    """
+
+    if not compressible_name(path):
+        return False
+    size = os.path.getsize(path)
+    fd = open(path, 'rb')
+    try:
+        samples = []
+        for offset in sorted(set([0, max(0, size / 2 - sample_size / 2),
+                                  max(0, size - sample_size)])):
+            fd.seek(offset)
+            samples.append(fd.read(sample_size))
+    finally:
+        fd.close()
+    return entropy(''.join(samples)) < entropy_threshold
+
+
+class MirrorError(Exception):
+    pass
+
+
+class Mirror(object):
+    """A lookaside mirror and what we know about its speed"""
+
+    def __init__(self, url, weight=1.0):
+        self.url = url.rstrip('/')
+        self.weight = weight
+        # Filled in by probing, or from the ranking cache.  healthy is
+        # None while unknown and False once the mirror could not be reached.
+        self.latency = None
+        self.speed = None
+        self.healthy = None
+        # Errors seen during this run
+        self.failures = 0
+
+    def cost(self, size=1048576):
+        """Estimated seconds to fetch size bytes, scaled down by weight"""
+
+        if self.healthy is not True or not self.speed:
+            return float('inf')
+        return (self.latency + size / self.speed) / self.weight
+
+    def __repr__(self):
+        return '<Mirror %s>' % self.url
+
+
+class MirrorList(object):
+    """An ordered, optionally weighted, list of lookaside mirrors
+
+    The mirrors are probed once for latency and throughput and the result
+    is cached, files are then spread across the healthy ones.
+    """
+
+    # Mirrors this many times slower than the best one are only used when
+    # the others fail.
+    slow_factor = 4
+    probe_size = 262144
+    probe_timeout = 10
+    # Downloads slower than stall_speed bytes/s for stall_time seconds
+    # are given up on, so that the next mirror gets a go
+    stall_speed = 1024
+    stall_time = 30
+    # Probe errors meaning the mirror is down, rather than just missing
+    # the probed file
+    down_errors = (pycurl.E_COULDNT_RESOLVE_HOST, pycurl.E_COULDNT_CONNECT,
+                   pycurl.E_OPERATION_TIMEOUTED)
+
+    def __init__(self, mirrors, cache_file=None, cache_ttl=86400, log=None):
+        """mirrors is a list of (url, weight) pairs, best first"""
+
+        self.mirrors = [Mirror(url, weight) for url, weight in mirrors]
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.log = log
+        self._ranked = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, primary, value, **kwargs):
+        """Create the list from the lookaside_mirrors config value
+
+        The value holds one mirror per line as "url [weight]".  Without a
+        weight, earlier mirrors are preferred.  The primary lookaside is
+        used if no mirrors are configured.
+        """
+
+        lines = [line.strip() for line in (value or '').splitlines()
+                 if line.strip() and not line.strip().startswith('#')]
+        if not lines:
+            lines = [primary]
+        mirrors = []
+        for position, line in enumerate(lines):
+            fields = line.split()
+            if len(fields) > 1:
+                try:
+                    weight = float(fields[1])
+                except ValueError:
+                    weight = None
+                if not weight > 0:
+                    raise MirrorError('Malformed lookaside_mirrors line "%s",'
+                                      ' expected "url [weight]" with a '
+                                      'positive weight' % line)
+            else:
+                weight = 1.0 / (1 + position * 0.1)
+            mirrors.append((fields[0], weight))
+        return cls(mirrors, **kwargs)
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def _cache_key(self):
+        return ' '.join('%s=%s' % (m.url, m.weight) for m in self.mirrors)
+
+    def _load_cache(self):
+        """Return the cached probe results for these mirrors, if fresh"""
+
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return None
+        try:
+            cache = json.load(open(self.cache_file))
+            entry = cache[self._cache_key()]
+        except (IOError, ValueError, KeyError):
+            return None
+        if time.time() - entry['time'] > self.cache_ttl:
+            return None
+        return entry['mirrors']
+
+    def _save_cache(self):
+        # Without a single good probe there is no ranking worth keeping
+        if not self.cache_file or \
+                not [m for m in self.mirrors if m.healthy is True]:
+            return
+        try:
+            cache = json.load(open(self.cache_file))
+        except (IOError, ValueError):
+            cache = {}
+        # A mirror which was down is not remembered as such, or it would
+        # be passed over until the cache expires, long after it is back
+        cache[self._cache_key()] = {
+            'time': time.time(),
+            'mirrors': dict((m.url, [m.latency, m.speed, m.healthy or None])
+                            for m in self.mirrors)}
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd = open(self.cache_file, 'w')
+            json.dump(cache, fd)
+            fd.close()
+        except (IOError, OSError), e:
+            if self.log:
+                self.log.debug('Could not cache mirror ranking: %s' % e)
+
+    def _probe(self, mirror, path):
+        """Time the download of the start of path from mirror"""
+
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.URL, '%s/%s' % (mirror.url, path))
+        curl.setopt(pycurl.RANGE, '0-%d' % (self.probe_size - 1))
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.CONNECTTIMEOUT, self.probe_timeout)
+        curl.setopt(pycurl.TIMEOUT, self.probe_timeout)
+        curl.setopt(pycurl.WRITEFUNCTION, lambda data: None)
+        try:
+            try:
+                curl.perform()
+            except pycurl.error, e:
+                if e.args[0] in self.down_errors:
+                    mirror.healthy = False
+                if self.log:
+                    self.log.debug('Probing %s failed: %s' % (mirror.url, e))
+                return
+            code = curl.getinfo(pycurl.HTTP_CODE)
+            if code not in (200, 206):
+                # Maybe the file has not been synced there yet
+                if self.log:
+                    self.log.debug('Probing %s gave HTTP %s' % (mirror.url,
+                                                                code))
+                return
+            mirror.healthy = True
+            mirror.latency = curl.getinfo(pycurl.STARTTRANSFER_TIME)
+            mirror.speed = curl.getinfo(pycurl.SPEED_DOWNLOAD)
+        finally:
+            curl.close()
+
+    def rank(self, path):
+        """Rank the mirrors, probing them with path unless cached
+
+        path is relative to the mirror urls and should name an existing
+        file, as a directory listing says little about throughput.
+        """
+
+        if self._ranked is not None:
+            return self._ranked
+        if len(self.mirrors) > 1:
+            cached = self._load_cache()
+            if cached is not None and set(cached) == \
+                    set(m.url for m in self.mirrors):
+                for mirror in self.mirrors:
+                    mirror.latency, mirror.speed, mirror.healthy = \
+                        cached[mirror.url]
+            else:
+                probes = [threading.Thread(target=self._probe,
+                                           args=(mirror, path))
+                          for mirror in self.mirrors]
+                for probe in probes:
+                    probe.start()
+                for probe in probes:
+                    probe.join()
+                self._save_cache()
+        # sort is stable, so the configured order breaks ties
+        self._ranked = sorted(self.mirrors,
+                              key=lambda m: (m.healthy is False, m.cost()))
+        if self.log:
+            for mirror in self._ranked:
+                self.log.debug('Mirror %s: latency %s, speed %s, healthy %s'
+                               % (mirror.url, mirror.latency, mirror.speed,
+                                  mirror.healthy))
+        return self._ranked
+
+    def healthy(self):
+        """Return the ranked mirrors worth spreading downloads across"""
+
+        ranked = self._ranked or self.mirrors
+        usable = [m for m in ranked
+                  if not m.failures and m.healthy is not False]
+        if not usable:
+            # Everything is down or failed, keep trying the best one
+            return ([m for m in ranked if not m.failures] or ranked)[:1]
+        best = usable[0].cost()
+        if best == float('inf'):
+            # Nothing could be measured, so spread across all of them
+            return usable
+        return [m for m in usable if m.cost() <= best * self.slow_factor]
+
+    def order(self, index):
+        """Return the mirrors to try, in order, for the index'th file
+
+        Files are spread round robin across the healthy mirrors, with the
+        remaining ones kept as a fallback.
+        """
+
+        self._lock.acquire()
+        try:
+            healthy = self.healthy()
+            start = index % len(healthy)
+            order = healthy[start:] + healthy[:start]
+            ranked = self._ranked or self.mirrors
+            return order + [m for m in ranked if m not in order]
+        finally:
+            self._lock.release()
+
+    def failed(self, mirror):
+        """Note that mirror failed a download, it is then tried last"""
+
+        self._lock.acquire()
+        try:
+            mirror.failures += 1
+        finally:
+            self._lock.release()
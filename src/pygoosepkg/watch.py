@@ -0,0 +1,213 @@
+# watch.py - watch many koji tasks at once for goosepkg
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+import sys
+import time
+import koji
+import errno
+import socket
+import httplib
+import xmlrpclib
+
+try:
+    import requests
+except ImportError:
+    # Older koji talks to the hub through xmlrpclib
+    requests = None
+
+# Errors talking to the hub.  IOError covers socket errors as well as the
+# requests exceptions of newer koji.
+hub_errors = (IOError, xmlrpclib.Error, httplib.HTTPException,
+              koji.GenericError)
+
+
+def transient(error, connected=True):
+    """Return whether a hub error is likely to go away by itself
+
+    Server errors, outages, timeouts and dropped connections are.  A
+    refused or unreachable connection only is if the hub was reached
+    before (connected), otherwise the hub url is most likely wrong.
+    Faults such as authentication or parameter errors never are.
+    """
+
+    if isinstance(error, getattr(koji, 'ServerOffline', ())):
+        return True
+    if isinstance(error, (koji.GenericError, xmlrpclib.Fault)):
+        return False
+    if isinstance(error, xmlrpclib.ProtocolError):
+        return error.errcode >= 500
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return response.status_code >= 500
+    if isinstance(error, socket.timeout) or (requests and isinstance(error,
+                                             requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, httplib.HTTPException):
+        return True
+    if isinstance(error, socket.error) and \
+            error.errno in (errno.ECONNRESET, errno.EPIPE, errno.ETIMEDOUT):
+        return True
+    return connected
+
+
+class TaskWatcher(object):
+    """Watch any number of koji tasks from a single polling loop
+
+    Task states are fetched with multicalls of up to batch_size tasks.
+    The poll interval doubles while nothing changes, up to max_interval,
+    and drops back as soon as a task changes state, so watching hundreds
+    of tasks costs the hub a handful of calls per interval.
+
+    Polls failing with transient errors are retried with the same backoff,
+    and a task is only given up on after it faulted max_faults polls in a
+    row.
+    """
+
+    # States in the order they are summarized
+    summary_states = ('FREE', 'ASSIGNED', 'OPEN', 'CLOSED', 'FAILED',
+                      'CANCELED')
+    done_states = ('CLOSED', 'FAILED', 'CANCELED')
+    # Consecutive faults before a task counts as failed
+    max_faults = 3
+    # Consecutive failed polls before giving up on the hub
+    max_errors = 20
+
+    def __init__(self, session, task_ids, out=sys.stdout, interval=5,
+                 max_interval=60, batch_size=100):
+        self.session = session
+        self.task_ids = list(task_ids)
+        self.out = out
+        self.interval = interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        # task id -> state name, None until first polled
+        self.states = dict((task_id, None) for task_id in self.task_ids)
+        self.methods = {}
+        self.faults = dict((task_id, 0) for task_id in self.task_ids)
+        self._last_summary = None
+        # Changes a failed poll did not get to return yet
+        self._changed = []
+
+    def pending(self):
+        """Return the ids of the tasks which are not done yet"""
+
+        return [task_id for task_id in self.task_ids
+                if self.states[task_id] not in self.done_states]
+
+    def poll(self):
+        """Update the state of the pending tasks, return what changed
+
+        Errors talking to the hub are raised, what changed before them is
+        returned by the next successful poll.
+        """
+
+        changed = self._changed
+        pending = self.pending()
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            self.session.multicall = True
+            for task_id in batch:
+                self.session.getTaskInfo(task_id)
+            results = self.session.multiCall()
+            for task_id, result in zip(batch, results):
+                if isinstance(result, dict):
+                    # A fault, which may well go away on the next poll
+                    self.faults[task_id] += 1
+                    if self.faults[task_id] < self.max_faults:
+                        continue
+                    state = 'FAILED'
+                    self.methods[task_id] = result.get('faultString', '')
+                elif not result or not result[0]:
+                    state = 'FAILED'
+                    self.methods[task_id] = 'no such task'
+                else:
+                    self.faults[task_id] = 0
+                    info = result[0]
+                    state = koji.TASK_STATES[info['state']]
+                    self.methods[task_id] = info.get('method', '')
+                if state != self.states[task_id] and task_id not in changed:
+                    changed.append(task_id)
+                self.states[task_id] = state
+        self._changed = []
+        return changed
+
+    def summary(self):
+        """Return a one line count of the tasks in each state"""
+
+        counts = dict((state, 0) for state in self.summary_states)
+        for state in self.states.values():
+            if state:
+                counts[state] = counts.get(state, 0) + 1
+        return ', '.join('%d %s' % (counts[state], state.lower())
+                         for state in self.summary_states if counts[state])
+
+    def report(self, changed):
+        """Print finished tasks and the summary line"""
+
+        tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        for task_id in changed:
+            if self.states[task_id] in self.done_states:
+                line = '%s (%s): %s' % (task_id, self.methods[task_id],
+                                        self.states[task_id].lower())
+                if tty:
+                    # Clear the live summary first
+                    line = '\r\033[K' + line
+                self.out.write(line + '\n')
+        summary = self.summary()
+        if tty:
+            self.out.write('\r\033[K%s' % summary)
+        elif summary != self._last_summary:
+            self.out.write(summary + '\n')
+        self._last_summary = summary
+        self.out.flush()
+
+    def watch(self):
+        """Poll until all tasks are done
+
+        Returns 0 if every task closed successfully, 1 otherwise.
+        """
+
+        tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        interval = self.interval
+        errors = 0
+        connected = False
+        while True:
+            try:
+                changed = self.poll()
+            except hub_errors, e:
+                errors += 1
+                if errors >= self.max_errors or \
+                        not transient(e, connected):
+                    raise
+                interval = min(interval * 2, self.max_interval)
+                line = 'Polling failed, retrying in %ss: %s' % (interval, e)
+                if tty:
+                    line = '\r\033[K' + line
+                self.out.write(line + '\n')
+                self.out.flush()
+                time.sleep(interval)
+                continue
+            errors = 0
+            connected = True
+            self.report(changed)
+            if not self.pending():
+                break
+            if changed:
+                interval = self.interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            time.sleep(interval)
+        if tty:
+            self.out.write('\n')
+        for state in self.states.values():
+            if state != 'CLOSED':
+                return 1
+        return 0
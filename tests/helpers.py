@@ -0,0 +1,121 @@
+# helpers.py - fixtures shared by the goosepkg tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# Importing this module also puts the source tree first on sys.path.
+
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pygoosepkg
+from pygoosepkg import lookaside
+
+
+class Server(object):
+    """An HTTP server on a free local port serving root
+
+    Every response is held back by delay seconds first.
+    """
+
+    def __init__(self, root, delay=0):
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                path = SimpleHTTPServer.SimpleHTTPRequestHandler. \
+                    translate_path(self, path)
+                return os.path.join(root, os.path.relpath(path, os.getcwd()))
+
+            def send_head(self):
+                server.requests.append(self.path)
+                if delay:
+                    time.sleep(delay)
+                return SimpleHTTPServer.SimpleHTTPRequestHandler. \
+                    send_head(self)
+
+            def log_message(self, *args):
+                pass
+
+        server = self
+        self.requests = []
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def closed_port_url():
+    """Return the url of a local port nothing listens on"""
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d' % port
+
+
+def script(dirname, name, body):
+    """Write an executable shell script, return its path"""
+
+    path = os.path.join(dirname, name)
+    open(path, 'w').write('#!/bin/sh\n' + body)
+    os.chmod(path, 0755)
+    return path
+
+
+def ssh_standin(dirname):
+    """Write an ssh stand-in running the remote script locally"""
+
+    return script(dirname, 'ssh', 'shift\nexec sh -c "$1"\n')
+
+
+def commands(path, mirrors=None, remote_dir='/srv/cache/lookaside',
+             **kwargs):
+    """Return Commands for the checkout at path
+
+    mirrors is a list of lookaside urls, the first one is the lookaside.
+    """
+
+    mirrors = mirrors or ['http://localhost']
+    cmd = pygoosepkg.Commands(path, mirrors[0], 'md5', 'localhost', 'goose',
+                              remote_dir, 'git://localhost',
+                              'git://localhost', r'master', None, 'koji',
+                              quiet=True, **kwargs)
+    cmd._lookaside_mirrors = lookaside.MirrorList(
+            [(url, 1.0) for url in mirrors], log=logging.getLogger())
+    return cmd
+
+
+class Index(object):
+    """Records the paths added to the git index"""
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, paths):
+        self.added.extend(paths)
+
+
+class Repo(object):
+    """Stands in for the git repository of a checkout"""
+
+    def __init__(self):
+        self.index = Index()
@@ -0,0 +1,124 @@
+# test_bundle.py - source bundle tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+import os
+import time
+import pycurl
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import helpers
+import pygoosepkg
+from pygoosepkg import bundle
+
+
+class BundleTest(unittest.TestCase):
+
+    data = 'foo sources\n' * 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='goosepkg-test-')
+        self.bundle = os.path.join(self.tmpdir, 'sources.bundle')
+        self.csum = hashlib.md5(self.data).hexdigest()
+        # Nothing listens there, so every download fails
+        self.cmd = helpers.commands(self.tmpdir,
+                                    [helpers.closed_port_url()])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def checkout(self, module, files):
+        """Create a checkout of module with the {filename: data} files"""
+
+        path = os.path.join(self.tmpdir, module)
+        os.makedirs(path)
+        sources = open(os.path.join(path, 'sources'), 'w')
+        for filename, data in sorted(files.items()):
+            sources.write('%s  %s\n' % (hashlib.md5(data).hexdigest(),
+                                        filename))
+            open(os.path.join(path, filename), 'w').write(data)
+        sources.close()
+        return path
+
+    def test_round_trip(self):
+        foo = self.checkout('foo', {'foo.tar': self.data})
+        bar = self.checkout('bar', {'bar.tar': self.data, 'bar.patch': 'x'})
+        self.cmd.bundle_export(self.bundle, [foo, bar])
+        reader = bundle.BundleReader(self.bundle)
+        # The shared content is stored once
+        self.assertEqual(len(reader.objects), 2)
+        self.assertEqual(reader.verify(), [])
+        reader.close()
+
+        cache = os.path.join(self.tmpdir, 'cache')
+        self.cmd.bundle_import(self.bundle, cache=cache)
+        for module, filename in (('foo', 'foo.tar'), ('bar', 'bar.tar')):
+            path = os.path.join(cache, module, self.csum, filename)
+            self.assertEqual(open(path).read(), self.data)
+
+    def test_export_failure(self):
+        foo = self.checkout('foo', {'foo.tar': self.data})
+        os.unlink(os.path.join(foo, 'foo.tar'))
+        self.assertRaises(pygoosepkg.goosepkgError, self.cmd.bundle_export,
+                          self.bundle, [foo])
+        self.assertFalse(os.path.exists(self.bundle))
+
+    def test_stalled_mirror(self):
+        root = os.path.join(self.tmpdir, 'mirror')
+        os.makedirs(os.path.join(root, 'foo', self.csum))
+        open(os.path.join(root, 'foo', self.csum, 'foo.tar'),
+             'w').write(self.data)
+        stalled = helpers.Server(root, delay=3)
+        try:
+            self.cmd.lookaside_mirrors.stall_time = 1
+            start = time.time()
+            self.assertRaises(pycurl.error, self.cmd._fetch,
+                              '%s/foo/%s/foo.tar' % (stalled.url, self.csum),
+                              lambda data: None)
+            self.assertTrue(time.time() - start < 2.5)
+        finally:
+            stalled.stop()
+
+    def test_missing_object(self):
+        # A module entry without its object, as older bundles could have
+        writer = bundle.BundleWriter(self.bundle, 'md5')
+        writer.write(self.csum, lambda write: write(self.data))
+        writer.add('foo', self.csum, 'foo.tar')
+        writer.add('bar', '0' * 32, 'bar.tar')
+        writer.close()
+
+        cache = os.path.join(self.tmpdir, 'cache')
+        self.cmd.bundle_import(self.bundle, cache=cache)
+        self.assertTrue(os.path.exists(os.path.join(cache, 'foo', self.csum,
+                                                    'foo.tar')))
+        self.assertFalse(os.path.exists(os.path.join(cache, 'bar')))
+
+    def test_unsafe_names(self):
+        cache = os.path.join(self.tmpdir, 'cache')
+        target = os.path.join(self.tmpdir, 'evil')
+        for module, filename in (('foo', '../../evil'), ('..', 'evil'),
+                                 ('foo', target), ('', 'evil'),
+                                 ('foo', '')):
+            writer = bundle.BundleWriter(self.bundle, 'md5')
+            writer.write(self.csum, lambda write: write(self.data))
+            writer.add(module, self.csum, filename)
+            writer.close()
+            self.assertRaises(pygoosepkg.goosepkgError,
+                              self.cmd.bundle_import, self.bundle,
+                              cache=cache)
+            self.assertFalse(os.path.exists(target))
+            self.assertFalse(os.path.exists(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
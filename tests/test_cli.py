@@ -0,0 +1,109 @@
+# test_cli.py - command line client tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# The clients skip the rpkg init, which reads the config and builds the
+# whole command tree, and get just the parsers the tests need.
+
+import types
+import argparse
+import unittest
+
+import helpers
+from pygoosepkg import cli
+
+
+class FullTree(cli.cliClient):
+    """Stands in for the rpkg command tree"""
+
+    def setup_subparsers(self):
+        self.subparsers.add_parser('sources')
+
+
+class Client(cli.goosepkgClient, FullTree):
+
+    def __init__(self, registers=None):
+        self._lazy = True
+        self._registers = registers
+        self.parser = argparse.ArgumentParser()
+        self.parser.add_argument('--path')
+        self.parser.add_argument('-q', action='store_true')
+        self.subparsers = self.parser.add_subparsers()
+
+    def setup_goose_subparsers(self):
+        self.subparsers.add_parser('clone')
+
+    def register_sources(self):
+        self.subparsers.add_parser('sources', parents=[self.common_parser])
+
+    def register_common(self):
+        self.common_parser = argparse.ArgumentParser(add_help=False)
+
+    def register_broken(self):
+        self.parser.no_such_method()
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = cli.registry
+        cli.registry = types.ModuleType('registry')
+        cli.registry.RPKG_CLI_DIGEST = cli.rpkg_cli_digest()
+        cli.registry.COMMANDS = {'sources': ['register_common',
+                                             'register_sources']}
+        cli.registry.PROVIDES = {'common_parser': 'register_common'}
+        self.client = Client()
+
+    def tearDown(self):
+        cli.registry = self.registry
+
+    def lookup(self, *argv):
+        return self.client.lookup_registers(list(argv))
+
+    def test_lookup(self):
+        registers = ['register_common', 'register_sources']
+        self.assertEqual(self.lookup('sources'), registers)
+        self.assertEqual(self.lookup('-q', 'sources', '--outdir', 'x'),
+                         registers)
+        self.assertEqual(self.lookup('--path', 'sources', 'sources'),
+                         registers)
+        self.assertEqual(self.lookup('--path=sources', 'sources'), registers)
+
+    def test_full_tree(self):
+        self.assertEqual(self.lookup('help'), None)
+        self.assertEqual(self.lookup('no-such-command'), None)
+        self.assertEqual(self.lookup('--path', 'x'), None)
+        self.assertEqual(self.lookup(), None)
+        cli.registry.RPKG_CLI_DIGEST = 'another pyrpkg'
+        self.assertEqual(self.lookup('sources'), None)
+        cli.registry = None
+        self.assertEqual(self.lookup('sources'), None)
+
+    def test_setup(self):
+        self.client._registers = ['register_common', 'register_sources']
+        self.client.setup_subparsers()
+        self.assertEqual(sorted(self.client.subparsers.choices), ['sources'])
+
+    def test_stale_registry(self):
+        # A renamed register method or a parent parser which moved
+        for registers in (['register_renamed'], ['register_sources']):
+            client = Client(registers)
+            client.setup_subparsers()
+            self.assertEqual(client._registers, None)
+            self.assertEqual(sorted(client.subparsers.choices),
+                             ['clone', 'sources'])
+
+    def test_broken_register(self):
+        self.client._registers = ['register_broken']
+        self.assertRaises(AttributeError, self.client.setup_subparsers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# test_delta.py - delta upload tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# The lookaside host is a temporary directory reached through an ssh
+# stand-in, so the remote scripts run for real.  rsync itself is replaced
+# by a plain copy into the staging directory.
+
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+import StringIO
+import subprocess
+
+import helpers
+
+
+def gzipped(data, *flags):
+    """Return data compressed by the gzip command"""
+
+    proc = subprocess.Popen(['gzip', '-c'] + list(flags),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return proc.communicate(data)[0]
+
+
+class DeltaTestCase(unittest.TestCase):
+
+    old = 'foo-1.0/foo.c\n' * 5000
+    new = 'foo-1.1/foo.c\n' * 5000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='goosepkg-test-')
+        self.remote_dir = os.path.join(self.tmpdir, 'lookaside')
+        self.checkout = os.path.join(self.tmpdir, 'foo')
+        os.makedirs(self.checkout)
+        self.cmd = helpers.commands(self.checkout,
+                                    remote_dir=self.remote_dir,
+                                    lookaside_ssh=helpers.ssh_standin(
+                                                            self.tmpdir))
+        self.cmd._module_name = 'foo'
+        self.commands = []
+        self.cmd._run_command = self.run_command
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_command(self, cmd, cwd=None):
+        """Record cmd, copying instead of running rsync"""
+
+        self.commands.append(cmd)
+        source = os.path.join(cwd, cmd[-2])
+        dest = cmd[-1].split(':', 1)[1]
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        shutil.copy(source, dest)
+
+    def md5(self, data):
+        return hashlib.md5(data).hexdigest()
+
+    def remote_file(self, csum, filename, data):
+        dirname = os.path.join(self.remote_dir, 'foo', csum)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        open(os.path.join(dirname, filename), 'w').write(data)
+
+    def local_file(self, filename, data):
+        path = os.path.join(self.checkout, filename)
+        open(path, 'w').write(data)
+        return path
+
+
+class FindBasisTest(DeltaTestCase):
+
+    def test_find_basis(self):
+        previous = [('a1', 'foo-0.9.tar.gz'), ('b1', 'bar-1.0.tar.gz'),
+                    ('a2', 'foo-1.0.tar.gz'), ('a3', 'foo-1.0.tar.xz'),
+                    ('a4', 'foo.patch')]
+        # The last matching name stem and extension wins
+        self.assertEqual(self.cmd._find_basis('foo-1.1.tar.gz', 'c1',
+                                              previous),
+                         ('a2', 'foo-1.0.tar.gz'))
+        self.assertEqual(self.cmd._find_basis('foo-1.1.tar.xz', 'c1',
+                                              previous),
+                         ('a3', 'foo-1.0.tar.xz'))
+        # The file itself is no basis
+        self.assertEqual(self.cmd._find_basis('foo-1.0.tar.gz', 'a2',
+                                              previous),
+                         ('a1', 'foo-0.9.tar.gz'))
+        self.assertEqual(self.cmd._find_basis('baz-1.0.tar.gz', 'c1',
+                                              previous), None)
+
+
+class RsyncTest(DeltaTestCase):
+
+    def test_rsync_basis(self):
+        path = self.local_file('foo-1.1.tar', self.new)
+        self.cmd._do_rsync(self.md5(self.new), path,
+                           ('a2', 'foo-1.0.tar'))
+        cmd = self.commands[0]
+        self.assertEqual(cmd[3:6], ['--copy-dest=../a2', '--fuzzy',
+                                    '--fuzzy'])
+        self.assertEqual(cmd[-2:], ['foo-1.1.tar',
+                                    'goose@localhost:%s/foo/%s/' %
+                                    (self.remote_dir, self.md5(self.new))])
+
+    def test_rsync(self):
+        path = self.local_file('foo-1.1.tar', self.new)
+        self.cmd._do_rsync(self.md5(self.new), path)
+        self.assertFalse([arg for arg in self.commands[0]
+                          if arg.startswith('--copy-dest') or
+                          arg == '--fuzzy'])
+
+
+class UncompressedDeltaTest(DeltaTestCase):
+
+    def setUp(self):
+        DeltaTestCase.setUp(self)
+        old = gzipped(self.old, '-n')
+        self.basis = (self.md5(old), 'foo-1.0.tar.gz')
+        self.remote_file(self.basis[0], self.basis[1], old)
+
+    def upload(self, data):
+        path = self.local_file('foo-1.1.tar.gz', data)
+        return self.cmd._do_uncompressed_delta(self.md5(data), path,
+                                               self.basis)
+
+    def uploaded(self, data):
+        return os.path.join(self.remote_dir, 'foo', self.md5(data),
+                            'foo-1.1.tar.gz')
+
+    def staging(self):
+        """Return the staging directories left on the lookaside host"""
+
+        return [name for name in os.listdir(os.path.join(self.remote_dir,
+                                                         'foo'))
+                if name.startswith('.delta-')]
+
+    def test_ok(self):
+        new = gzipped(self.new, '-n')
+        self.assertTrue(self.upload(new))
+        # The plain tar went over and was compressed again on the host
+        self.assertEqual(self.commands[0][-2], 'foo-1.1.tar')
+        self.assertEqual(open(self.uploaded(new)).read(), new)
+        self.assertEqual(self.staging(), [])
+
+    def test_remote_mismatch(self):
+        new = gzipped(self.new, '-n')
+        run_command = self.run_command
+
+        def corrupting_rsync(cmd, cwd=None):
+            run_command(cmd, cwd)
+            dest = cmd[-1].split(':', 1)[1]
+            open(os.path.join(dest, cmd[-2]), 'a').write('junk')
+        self.cmd._run_command = corrupting_rsync
+        # The host does not get the same file back, so nothing is kept
+        self.assertFalse(self.upload(new))
+        self.assertFalse(os.path.exists(self.uploaded(new)))
+        self.assertFalse(os.path.exists(self.uploaded(new) + '.part'))
+        self.assertEqual(self.staging(), [])
+
+    def test_not_reproducible(self):
+        # A gzip header with a name and time in it cannot be reproduced
+        output = StringIO.StringIO()
+        compressed = gzip.GzipFile('foo-1.1.tar', 'wb', 9, output, 12345)
+        compressed.write(self.new)
+        compressed.close()
+        self.assertFalse(self.upload(output.getvalue()))
+        self.assertEqual(self.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
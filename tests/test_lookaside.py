@@ -0,0 +1,248 @@
+# test_lookaside.py - lookaside mirror ranking and failover tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# The mirrors are plain HTTP servers on localhost, serving a lookaside
+# tree from a temporary directory.
+
+import os
+import random
+import shutil
+import tarfile
+import hashlib
+import tempfile
+import unittest
+
+import helpers
+import pygoosepkg
+from pygoosepkg import lookaside
+
+
+class SourceStemTest(unittest.TestCase):
+
+    def test_source_stem(self):
+        for filename, stem in (('foo-1.2.tar.xz', ('foo', '.tar.xz')),
+                               ('foo-2.0.tgz', ('foo', '.tgz')),
+                               ('foo_v2.0.zip', ('foo', '.zip')),
+                               ('python-foo-1.0~rc1.tar.gz',
+                                ('python-foo', '.tar.gz')),
+                               ('foo-1.2.patch', ('foo', '.patch')),
+                               ('bar.tar.bz2', ('bar', '.tar.bz2')),
+                               ('README', ('README', ''))):
+            self.assertEqual(lookaside.source_stem(filename), stem)
+
+
+class CompressibleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='goosepkg-test-')
+        # Random, yet the same on every run
+        self.random = random.Random(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def noise(self, size):
+        return ''.join(chr(self.random.randrange(256)) for i in xrange(size))
+
+    def write(self, filename, data):
+        path = os.path.join(self.tmpdir, filename)
+        open(path, 'wb').write(data)
+        return path
+
+    def test_entropy(self):
+        self.assertEqual(lookaside.entropy(''), 0.0)
+        self.assertEqual(lookaside.entropy('a' * 100), 0.0)
+        self.assertEqual(lookaside.entropy('ab' * 100), 1.0)
+        self.assertEqual(lookaside.entropy(''.join(map(chr, range(256)))),
+                         8.0)
+
+    def test_compressible_name(self):
+        self.assertTrue(lookaside.compressible_name('foo-1.0.tar'))
+        self.assertTrue(lookaside.compressible_name('foo.patch'))
+        self.assertFalse(lookaside.compressible_name('foo-1.0.tar.xz'))
+        self.assertFalse(lookaside.compressible_name('FOO.ZIP'))
+
+    def test_text_tarball(self):
+        readme = self.write('README', 'foo sources\n' * 10000)
+        path = os.path.join(self.tmpdir, 'foo.tar')
+        tar = tarfile.open(path, 'w')
+        tar.add(readme, 'foo/README')
+        tar.close()
+        self.assertTrue(lookaside.compressible(path))
+
+    def test_random_tarball(self):
+        # Compressed data the name does not give away
+        path = self.write('foo.tar', self.noise(200000))
+        self.assertFalse(lookaside.compressible(path))
+        self.assertFalse(lookaside.compressible(path, sample_size=4096))
+
+    def test_compressed_name(self):
+        # Not even looked at
+        path = self.write('foo.tar.xz', 'foo sources\n' * 1000)
+        self.assertFalse(lookaside.compressible(path))
+
+    def test_small_files(self):
+        self.assertTrue(lookaside.compressible(self.write('empty', '')))
+        text = self.write('foo.patch', 'foo sources\n' * 10)
+        self.assertTrue(lookaside.compressible(text))
+        noise = self.write('foo.tar', self.noise(8192))
+        self.assertFalse(lookaside.compressible(noise))
+        self.assertFalse(lookaside.compressible(noise, sample_size=5000))
+
+
+class FromConfigTest(unittest.TestCase):
+
+    def test_from_config(self):
+        mirrors = lookaside.MirrorList.from_config('http://primary', """
+            # The closest one
+            http://a/ 2.5
+
+            http://b
+            http://c
+            """)
+        self.assertEqual([(m.url, m.weight) for m in mirrors.mirrors],
+                         [('http://a', 2.5), ('http://b', 1 / 1.1),
+                          ('http://c', 1 / 1.2)])
+        mirrors = lookaside.MirrorList.from_config('http://primary', '')
+        self.assertEqual([(m.url, m.weight) for m in mirrors.mirrors],
+                         [('http://primary', 1.0)])
+
+    def test_bad_weight(self):
+        for line in ('http://b fast', 'http://b 0', 'http://b -1'):
+            try:
+                lookaside.MirrorList.from_config('http://primary',
+                                                 'http://a\n%s\n' % line)
+            except lookaside.MirrorError, e:
+                self.assertTrue(line in str(e))
+            else:
+                self.fail('%s was accepted' % line)
+
+    def test_commands(self):
+        cmd = helpers.commands(os.getcwd(),
+                               lookaside_mirrors='http://a fast')
+        cmd._lookaside_mirrors = None
+        self.assertRaises(pygoosepkg.goosepkgError,
+                          lambda: cmd.lookaside_mirrors)
+
+
+class MirrorTestCase(unittest.TestCase):
+
+    module = 'foo'
+    data = 'foo sources\n' * 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='goosepkg-test-')
+        self.servers = []
+        self.csum = hashlib.md5(self.data).hexdigest()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def mirror(self, files):
+        """Start a mirror serving the {filename: data} files of module"""
+
+        root = tempfile.mkdtemp(dir=self.tmpdir)
+        for filename, data in files.items():
+            dirname = os.path.join(root, self.module, self.csum)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            open(os.path.join(dirname, filename), 'w').write(data)
+        server = helpers.Server(root)
+        self.servers.append(server)
+        return server.url
+
+
+class RankTest(MirrorTestCase):
+
+    def test_rank(self):
+        missing = self.mirror({})
+        down = helpers.closed_port_url()
+        good = self.mirror({'foo.tar': self.data})
+        cache_file = os.path.join(self.tmpdir, 'cache', 'mirrors.json')
+        mirrors = lookaside.MirrorList([(missing, 1.0), (down, 1.0),
+                                        (good, 1.0)], cache_file=cache_file)
+        ranked = mirrors.rank('%s/%s/foo.tar' % (self.module, self.csum))
+        self.assertEqual([m.url for m in ranked], [good, missing, down])
+        self.assertEqual([m.healthy for m in ranked], [True, None, False])
+        self.assertEqual([m.url for m in mirrors.healthy()], [good])
+        self.assertTrue(os.path.exists(cache_file))
+
+        # A new run uses the cached ranking without probing again
+        for server in self.servers:
+            server.stop()
+        self.servers = []
+        cached = lookaside.MirrorList([(missing, 1.0), (down, 1.0),
+                                       (good, 1.0)], cache_file=cache_file)
+        ranked = cached.rank('%s/%s/foo.tar' % (self.module, self.csum))
+        self.assertEqual([m.url for m in ranked], [good, missing, down])
+        # Being down is not remembered, the mirror may be back by now
+        self.assertEqual([m.healthy for m in ranked], [True, None, None])
+        self.assertEqual([m.url for m in cached.healthy()], [good])
+
+    def test_nothing_measured(self):
+        first = self.mirror({})
+        second = self.mirror({})
+        cache_file = os.path.join(self.tmpdir, 'mirrors.json')
+        mirrors = lookaside.MirrorList([(first, 1.0), (second, 1.0)],
+                                       cache_file=cache_file)
+        mirrors.rank('%s/%s/foo.tar' % (self.module, self.csum))
+        # A missing file says nothing about the mirrors, so both stay in
+        # use and the ranking is not cached
+        self.assertEqual([m.url for m in mirrors.healthy()], [first, second])
+        self.assertFalse(os.path.exists(cache_file))
+
+    def test_order(self):
+        mirrors = lookaside.MirrorList([('http://a', 1.0), ('http://b', 1.0)])
+        self.assertEqual([m.url for m in mirrors.order(1)],
+                         ['http://b', 'http://a'])
+        mirrors.failed(mirrors.mirrors[1])
+        self.assertEqual([m.url for m in mirrors.order(1)],
+                         ['http://a', 'http://b'])
+
+
+class FailoverTest(MirrorTestCase):
+
+    def test_bad_checksum(self):
+        bad = self.mirror({'foo.tar': 'not foo\n', 'bar.tar': 'not foo\n'})
+        good = self.mirror({'foo.tar': self.data, 'bar.tar': self.data})
+        cmd = helpers.commands(self.tmpdir, [bad, good])
+        downloads = [(self.csum, filename, os.path.join(self.tmpdir, filename))
+                     for filename in ('foo.tar', 'bar.tar')]
+        # Whichever mirror a file starts with, it ends up from the good one
+        cmd._download_sources(self.module, downloads)
+        for csum, filename, outfile in downloads:
+            self.assertEqual(open(outfile).read(), self.data)
+        self.assertFalse(cmd.lookaside_mirrors.mirrors[1].failures)
+
+    def test_next_mirror(self):
+        bad = self.mirror({'foo.tar': 'not foo\n'})
+        good = self.mirror({'foo.tar': self.data})
+        cmd = helpers.commands(self.tmpdir, [bad, good])
+        outfile = os.path.join(self.tmpdir, 'foo.tar')
+        cmd._download_source(self.module, self.csum, 'foo.tar', outfile,
+                             cmd.lookaside_mirrors.mirrors)
+        self.assertEqual(open(outfile).read(), self.data)
+        self.assertEqual([m.failures for m in cmd.lookaside_mirrors.mirrors],
+                         [1, 0])
+
+    def test_all_bad(self):
+        bad = self.mirror({'foo.tar': 'not foo\n'})
+        cmd = helpers.commands(self.tmpdir, [bad, helpers.closed_port_url()])
+        outfile = os.path.join(self.tmpdir, 'foo.tar')
+        self.assertRaises(pygoosepkg.goosepkgError, cmd._download_sources,
+                          self.module, [(self.csum, 'foo.tar', outfile)])
+        self.assertFalse(os.path.exists(outfile))
+
+
+if __name__ == '__main__':
+    unittest.main()
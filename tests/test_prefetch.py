@@ -0,0 +1,153 @@
+# test_prefetch.py - background source prefetching tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# The checkouts are real git repositories and the lookaside a local HTTP
+# server, which can be slowed down to keep a prefetch in flight.
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import subprocess
+
+import helpers
+
+
+def git(cwd, *args):
+    subprocess.check_call(['git', '-c', 'user.name=goosepkg',
+                           '-c', 'user.email=goosepkg@localhost'] +
+                          list(args), cwd=cwd, stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
+
+
+class PrefetchTest(unittest.TestCase):
+
+    data = 'foo sources\n' * 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='goosepkg-test-')
+        self.csum = hashlib.md5(self.data).hexdigest()
+        root = os.path.join(self.tmpdir, 'lookaside')
+        os.makedirs(os.path.join(root, 'foo', self.csum))
+        open(os.path.join(root, 'foo', self.csum, 'foo.tar'),
+             'w').write(self.data)
+        self.root = root
+        self.servers = []
+        self.checkout = self.git_checkout(os.path.join(self.tmpdir, 'foo'))
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def git_checkout(self, path):
+        os.makedirs(path)
+        git(path, 'init', '-q')
+        open(os.path.join(path, 'sources'), 'w').write('%s  foo.tar\n' %
+                                                       self.csum)
+        git(path, 'add', 'sources')
+        git(path, 'commit', '-q', '-m', 'Add sources')
+        return path
+
+    def commands(self, path, delay=0):
+        server = helpers.Server(self.root, delay=delay)
+        self.servers.append(server)
+        cmd = helpers.commands(path, [server.url])
+        cmd._module_name = 'foo'
+        return cmd, server
+
+    def lockfile(self, git_dir):
+        return os.path.join(git_dir, 'goosepkg-prefetch', 'foo.tar')
+
+    def test_attach(self):
+        cmd, server = self.commands(self.checkout, delay=1)
+        start = time.time()
+        pid = cmd.prefetch_sources()
+        self.assertTrue(pid)
+        try:
+            # sources() waits for the prefetch instead of downloading again
+            cmd.sources()
+            self.assertTrue(time.time() - start >= 1)
+            self.assertEqual(open(os.path.join(self.checkout,
+                                               'foo.tar')).read(), self.data)
+            self.assertEqual(len(server.requests), 1)
+            self.assertFalse(os.path.exists(self.lockfile(
+                    os.path.join(self.checkout, '.git'))))
+        finally:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_stale_lock(self):
+        # A prefetch which died without cleaning up
+        lockfile = self.lockfile(os.path.join(self.checkout, '.git'))
+        os.makedirs(os.path.dirname(lockfile))
+        open(lockfile, 'w').close()
+        cmd, server = self.commands(self.checkout)
+        cmd.sources()
+        self.assertEqual(open(os.path.join(self.checkout, 'foo.tar')).read(),
+                         self.data)
+        self.assertFalse(os.path.exists(lockfile))
+
+    def test_replaced_lock(self):
+        cmd, server = self.commands(self.checkout)
+        git_dir = os.path.join(self.checkout, '.git')
+        lockfile = self.lockfile(git_dir)
+        os.makedirs(os.path.dirname(lockfile))
+        running = open(lockfile, 'w')
+        fcntl.flock(running, fcntl.LOCK_EX)
+        waiter = threading.Thread(target=cmd._wait_prefetch,
+                                  args=(git_dir, 'foo.tar'))
+        waiter.start()
+        time.sleep(0.2)
+        # The running prefetch finishes and a new one starts
+        os.unlink(lockfile)
+        new = cmd._lock_prefetch(lockfile)
+        running.close()
+        waiter.join()
+        self.assertTrue(os.path.exists(lockfile))
+        self.assertTrue(cmd._holds_lock(new, lockfile))
+        new.close()
+
+    def test_worktree(self):
+        worktree = os.path.join(self.tmpdir, 'wt')
+        git(self.checkout, 'worktree', 'add', '-q', worktree)
+        cmd, server = self.commands(worktree)
+        git_dir = cmd._git_dir(worktree)
+        self.assertEqual(git_dir, os.path.join(self.checkout, '.git',
+                                               'worktrees', 'wt'))
+        pid = cmd.prefetch_sources()
+        try:
+            cmd.sources()
+        finally:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(open(os.path.join(worktree, 'foo.tar')).read(),
+                         self.data)
+        self.assertTrue(os.path.exists(os.path.join(git_dir,
+                                                    'goosepkg-prefetch.log')))
+
+    def test_not_git(self):
+        path = os.path.join(self.tmpdir, 'plain')
+        os.makedirs(path)
+        open(os.path.join(path, 'sources'), 'w').write('%s  foo.tar\n' %
+                                                       self.csum)
+        cmd, server = self.commands(path)
+        self.assertEqual(cmd._git_dir(path), None)
+        self.assertEqual(cmd.prefetch_sources(), None)
+        cmd.sources()
+        self.assertEqual(open(os.path.join(path, 'foo.tar')).read(),
+                         self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
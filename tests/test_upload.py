@@ -0,0 +1,151 @@
+# test_upload.py - lookaside upload tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# The lookaside host is a temporary directory, reached through an ssh
+# stand-in which runs the remote script locally.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import helpers
+import pygoosepkg
+
+
+class UploadTestCase(unittest.TestCase):
+
+    data = 'foo sources\n' * 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='goosepkg-test-')
+        self.remote_dir = os.path.join(self.tmpdir, 'lookaside')
+        self.checkout = os.path.join(self.tmpdir, 'foo')
+        os.makedirs(self.checkout)
+        self.cmd = helpers.commands(self.checkout,
+                                    remote_dir=self.remote_dir,
+                                    lookaside_ssh=helpers.ssh_standin(
+                                                            self.tmpdir))
+        self.cmd._module_name = 'foo'
+        self.cmd._repo = helpers.Repo()
+        self.rsynced = []
+        self.cmd._do_rsync = lambda file_hash, filename, basis=None: \
+            self.rsynced.append(os.path.basename(filename))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def script(self, name, body):
+        return helpers.script(self.tmpdir, name, body)
+
+    def remote_file(self, module, csum, filename, data):
+        dirname = os.path.join(self.remote_dir, module, csum)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        path = os.path.join(dirname, filename)
+        open(path, 'w').write(data)
+        return path
+
+    def local_file(self, filename, data):
+        path = os.path.join(self.checkout, filename)
+        open(path, 'w').write(data)
+        return path
+
+    def source(self, path):
+        return (self.cmd._hash_file(path, 'md5'), os.path.basename(path),
+                os.path.getsize(path), self.cmd._hash_file(path, 'sha256'))
+
+
+class LinkExistingTest(UploadTestCase):
+
+    def test_link(self):
+        csum = hashlib.md5(self.data).hexdigest()
+        other = self.remote_file('bar', csum, 'bar.tar', self.data)
+        path = self.local_file('foo.tar', self.data)
+        status = self.cmd.link_existing([self.source(path)])
+        self.assertEqual(status, {'foo.tar': 'linked'})
+        linked = os.path.join(self.remote_dir, 'foo', csum, 'foo.tar')
+        self.assertEqual(os.stat(linked).st_ino, os.stat(other).st_ino)
+        # The second time around it is there already
+        status = self.cmd.link_existing([self.source(path)])
+        self.assertEqual(status, {'foo.tar': 'exists'})
+
+    def test_collision(self):
+        # Same lookaside hash and size, different content
+        csum = hashlib.md5(self.data).hexdigest()
+        self.remote_file('bar', csum, 'bar.tar', self.data.upper())
+        path = self.local_file('foo.tar', self.data)
+        status = self.cmd.link_existing([self.source(path)])
+        self.assertEqual(status, {'foo.tar': 'missing'})
+        self.assertFalse(os.path.exists(os.path.join(self.remote_dir, 'foo')))
+
+    def test_missing(self):
+        path = self.local_file('foo.tar', self.data)
+        status = self.cmd.link_existing([self.source(path)])
+        self.assertEqual(status, {'foo.tar': 'missing'})
+
+    def test_remote_failure(self):
+        self.cmd.lookaside_ssh = self.script('down', 'echo down >&2\n'
+                                                     'exit 255\n')
+        path = self.local_file('foo.tar', self.data)
+        self.assertRaises(pygoosepkg.goosepkgError, self.cmd.link_existing,
+                          [self.source(path)])
+
+
+class UploadTest(UploadTestCase):
+
+    def test_upload(self):
+        csum = hashlib.md5(self.data).hexdigest()
+        self.remote_file('bar', csum, 'foo.tar', self.data)
+        foo = self.local_file('foo.tar', self.data)
+        bar = self.local_file('bar.tar', 'bar sources\n')
+        self.cmd.upload([foo, bar], replace=True)
+        self.assertEqual(self.rsynced, ['bar.tar'])
+        self.assertEqual(open(os.path.join(self.checkout, 'sources')).read(),
+                         '%s  foo.tar\n%s  bar.tar\n' %
+                         (csum, hashlib.md5('bar sources\n').hexdigest()))
+
+    def test_remote_failure(self):
+        self.cmd.lookaside_ssh = self.script('down', 'echo down >&2\n'
+                                                     'exit 255\n')
+        sources = os.path.join(self.checkout, 'sources')
+        open(sources, 'w').write('%s  old.tar\n' % ('0' * 32))
+        foo = self.local_file('foo.tar', self.data)
+        cwd = os.getcwd()
+        self.cmd.upload([foo], replace=True)
+        # Everything is uploaded instead
+        self.assertEqual(self.rsynced, ['foo.tar'])
+        self.assertEqual(open(sources).read(), '%s  foo.tar\n' %
+                         hashlib.md5(self.data).hexdigest())
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_malformed_sources(self):
+        sources = os.path.join(self.checkout, 'sources')
+        open(sources, 'w').write('garbage\n\n')
+        foo = self.local_file('foo.tar', self.data)
+        self.cmd.upload([foo], replace=True)
+        self.assertEqual(open(sources).read(), '%s  foo.tar\n' %
+                         hashlib.md5(self.data).hexdigest())
+
+    def test_rsync_failure(self):
+        def fail(file_hash, filename, basis=None):
+            raise pygoosepkg.goosepkgError('rsync failed')
+        self.cmd._do_rsync = fail
+        open(os.path.join(self.checkout, 'sources'), 'w').write('')
+        foo = self.local_file('foo.tar', self.data)
+        cwd = os.getcwd()
+        self.assertRaises(pygoosepkg.goosepkgError, self.cmd.upload, [foo])
+        self.assertEqual(os.getcwd(), cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
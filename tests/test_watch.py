@@ -0,0 +1,185 @@
+# test_watch.py - koji task watcher tests
+#
+# Copyright (C) 2013 GoOSe Project
+# Author(s):  Clint Savage <herlo@gooseproject.org>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# The hub is a local XML-RPC server answering koji's multiCall, talked to
+# through a real koji.ClientSession.
+
+import os
+import koji
+import time
+import errno
+import socket
+import unittest
+import threading
+import StringIO
+import xmlrpclib
+import SimpleXMLRPCServer
+
+import helpers
+from pygoosepkg import watch
+
+
+class Hub(object):
+    """A hub whose tasks step through the given states, one per poll
+
+    tasks maps task ids to a list of states, a state of None makes
+    getTaskInfo fault.  The first outages requests get an HTTP 502, while
+    fault, a koji exception class, makes every multiCall fail with it.
+    """
+
+    def __init__(self, tasks, outages=0, fault=None):
+        self.tasks = tasks
+        self.outages = outages
+        self.fault = fault
+        self.calls = 0
+        hub = self
+
+        class Handler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+            def do_POST(self):
+                if hub.outages:
+                    hub.outages -= 1
+                    self.send_response(502)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+                ('127.0.0.1', 0), Handler, logRequests=False, allow_none=True)
+        self.server.register_function(self.multiCall, 'multiCall')
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def multiCall(self, calls):
+        self.calls += 1
+        if self.fault:
+            raise xmlrpclib.Fault(self.fault.faultCode, 'hub says no')
+        results = []
+        for call in calls:
+            task_id = call['params'][0]
+            if task_id not in self.tasks:
+                results.append([None])
+                continue
+            states = self.tasks[task_id]
+            state = states[0]
+            if len(states) > 1:
+                states.pop(0)
+            if state is None:
+                results.append({'faultCode': 1000,
+                                'faultString': 'database busy'})
+            else:
+                results.append([{'id': task_id, 'method': 'build',
+                                 'state': koji.TASK_STATES[state]}])
+        return results
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class WatchTest(unittest.TestCase):
+
+    def tearDown(self):
+        self.hub.stop()
+
+    def watcher(self, task_ids, **kwargs):
+        session = koji.ClientSession(self.hub.url)
+        self.out = StringIO.StringIO()
+        return watch.TaskWatcher(session, task_ids, out=self.out,
+                                 interval=0.01, max_interval=0.05, **kwargs)
+
+    def test_watch(self):
+        self.hub = Hub({1: ['OPEN', 'CLOSED'],
+                        2: ['FREE', 'OPEN', 'OPEN', 'CLOSED'],
+                        3: ['OPEN', 'FAILED']})
+        watcher = self.watcher([1, 2, 3], batch_size=2)
+        self.assertEqual(watcher.watch(), 1)
+        self.assertEqual(watcher.states, {1: 'CLOSED', 2: 'CLOSED',
+                                          3: 'FAILED'})
+        self.assertTrue('3 (build): failed\n' in self.out.getvalue())
+
+    def test_outage(self):
+        self.hub = Hub({1: ['OPEN', 'CLOSED']}, outages=2)
+        watcher = self.watcher([1])
+        self.assertEqual(watcher.watch(), 0)
+        self.assertEqual(self.out.getvalue().count('Polling failed'), 2)
+
+    def test_hub_down(self):
+        self.hub = Hub({1: ['OPEN']}, outages=1000)
+        watcher = self.watcher([1])
+        watcher.max_errors = 3
+        self.assertRaises(watch.hub_errors, watcher.watch)
+        self.assertEqual(self.hub.outages, 997)
+
+    def test_auth_error(self):
+        self.hub = Hub({1: ['OPEN']}, fault=koji.AuthError)
+        watcher = self.watcher([1])
+        self.assertRaises(koji.AuthError, watcher.watch)
+        self.assertEqual(self.hub.calls, 1)
+
+    def test_wrong_url(self):
+        self.hub = Hub({1: ['OPEN']})
+        watcher = self.watcher([1])
+        watcher.session = koji.ClientSession(helpers.closed_port_url())
+        start = time.time()
+        self.assertRaises(watch.hub_errors, watcher.watch)
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse('Polling failed' in self.out.getvalue())
+
+    def test_faults(self):
+        # Passing faults are ignored, lasting ones fail the task
+        self.hub = Hub({1: [None, None, 'OPEN', 'CLOSED'], 2: [None]})
+        watcher = self.watcher([1, 2])
+        self.assertEqual(watcher.watch(), 1)
+        self.assertEqual(watcher.states, {1: 'CLOSED', 2: 'FAILED'})
+        self.assertEqual(watcher.methods[2], 'database busy')
+
+    def test_no_such_task(self):
+        self.hub = Hub({1: ['CLOSED']})
+        watcher = self.watcher([1, 2])
+        self.assertEqual(watcher.watch(), 1)
+        self.assertEqual(self.hub.calls, 1)
+        self.assertEqual(watcher.methods[2], 'no such task')
+
+    def test_session(self):
+        # Commands polls through the session it is given, as rpkg's build
+        # commands pass their own
+        self.hub = Hub({1: ['CLOSED']})
+        cmd = helpers.commands(os.getcwd())
+        self.assertEqual(cmd.watch_tasks([1], interval=0.01,
+                                         session=koji.ClientSession(
+                                                    self.hub.url)), 0)
+        self.assertEqual(self.hub.calls, 1)
+
+
+class TransientTest(unittest.TestCase):
+
+    def test_transient(self):
+        self.assertTrue(watch.transient(koji.ServerOffline('down')))
+        self.assertFalse(watch.transient(koji.ParameterError('bad')))
+        self.assertTrue(watch.transient(xmlrpclib.ProtocolError(
+                                            'hub', 503, 'Unavailable', {})))
+        self.assertFalse(watch.transient(xmlrpclib.ProtocolError(
+                                            'hub', 404, 'Not Found', {})))
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        self.assertFalse(watch.transient(refused, connected=False))
+        self.assertTrue(watch.transient(refused, connected=True))
+        self.assertTrue(watch.transient(socket.timeout('timed out'),
+                                        connected=False))
+
+
+if __name__ == '__main__':
+    unittest.main()